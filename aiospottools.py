@@ -0,0 +1,429 @@
+"""An asyncio variant of the core SpotUserActions operations:
+one process can sync many users at once over a pooled HTTP client.
+The merge logic and the store are the same of spottools
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from functools import partial
+
+import click
+from spotipy import SpotifyException
+
+from metrics import metrics
+from spotclient import RetryingClientMixin, endpoint_name
+from spottools import (
+    OUTBOX_BATCH_SIZES,
+    LikesIngest,
+    PlaysIngest,
+    SpotifyConnectionException,
+    SpotUserActions,
+    get_auth_manager,
+    likes_need_reconciliation,
+    page_url,
+    playlist_sync_key,
+    playlist_sync_state,
+    reverse_block_chunks,
+    save_playlist_sync,
+    stored_likes,
+    stored_likes_count,
+    sync_merge,
+)
+from store import Liked, Message, SyncState, User, write_batch
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger("spotlike.aiospottools")
+
+
+def http_client():
+    """A pooled HTTP client, for all the users of a run - to use as a context manager:
+    it's bound to the event loop where it's used
+    """
+    if httpx is None:
+        raise RuntimeError("The async client needs httpx: `pip install httpx`")
+    return httpx.AsyncClient(
+        timeout=30,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run the blocking calls (the DB, the token refresh) out of the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+async def achunked(iterable, size):
+    """The items of an async iterable, in lists of `size`"""
+    chunk = []
+    async for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class AsyncSpotify(RetryingClientMixin):
+    """The few Spotify endpoints we need, as coroutines - with the same retries
+    and the same shared rate limiter of the sync client
+    """
+
+    prefix = "https://api.spotify.com/v1/"
+
+    def __init__(self, auth_manager, client, max_retries=8, limiter=None, stats=None):
+        self.auth_manager = auth_manager
+        self.client = client
+        self.setup_retries(max_retries, limiter, stats)
+
+    @staticmethod
+    def not_sent(error):
+        return isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+
+    async def _auth_headers(self):
+        token = await run_blocking(self.auth_manager.get_access_token, as_dict=False)
+        return {"Authorization": f"Bearer {token}"}
+
+    async def _request(self, method, url, payload=None, **params):
+        if not url.startswith("http"):
+            url = self.prefix + url
+        # the next pages come with their own query string
+        params = {k: v for k, v in params.items() if v is not None} or None
+        endpoint = f"{method} {endpoint_name(url)}"
+        attempt = 0
+        while True:
+            throttled = self.limiter.reserve()
+            if throttled:
+                await asyncio.sleep(throttled)
+            self.count_request(throttled, endpoint)
+            try:
+                with metrics.timer("spotify_request_seconds", endpoint=endpoint):
+                    response = await self.client.request(
+                        method,
+                        url,
+                        params=params,
+                        json=payload,
+                        headers=await self._auth_headers(),
+                    )
+                if response.is_error:
+                    raise spotify_exception(response)
+                return response.json() if response.content else None
+            except (SpotifyException, httpx.TransportError) as e:
+                delay = self.next_retry_delay(
+                    e, attempt, f"{method} {url}", endpoint=endpoint, method=method
+                )
+                if delay is None:
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def next(self, result):
+        if result["next"]:
+            return await self._request("GET", result["next"])
+
+    async def current_user(self):
+        return await self._request("GET", "me/")
+
+    async def current_user_playlists(self, limit=50, offset=0):
+        return await self._request("GET", "me/playlists", limit=limit, offset=offset)
+
+    async def user_playlist_create(self, user, name, public=True, description=""):
+        payload = dict(name=name, public=public, description=description)
+        return await self._request("POST", f"users/{user}/playlists", payload)
+
+    async def current_user_unfollow_playlist(self, playlist_id):
+        return await self._request("DELETE", f"playlists/{playlist_id}/followers")
+
+    async def playlist(self, playlist_id, fields=None):
+        return await self._request("GET", f"playlists/{playlist_id}", fields=fields)
+
+    async def playlist_items(self, playlist_id, limit=100, offset=0):
+        return await self._request(
+            "GET",
+            f"playlists/{playlist_id}/tracks",
+            limit=limit,
+            offset=offset,
+            additional_types="track",
+        )
+
+    async def playlist_add_items(self, playlist_id, items, position=None):
+        payload = dict(uris=[track_uri(item) for item in items], position=position)
+        return await self._request("POST", f"playlists/{playlist_id}/tracks", payload)
+
+    async def playlist_remove_all_occurrences_of_items(self, playlist_id, items):
+        payload = dict(tracks=[dict(uri=track_uri(item)) for item in items])
+        return await self._request("DELETE", f"playlists/{playlist_id}/tracks", payload)
+
+    async def current_user_saved_tracks(self, limit=50, offset=0):
+        return await self._request("GET", "me/tracks", limit=limit, offset=offset)
+
+    async def current_user_saved_tracks_delete(self, tracks):
+        return await self._request("DELETE", "me/tracks", ids=",".join(tracks))
+
+    async def current_user_recently_played(self, limit=50, after=None, before=None):
+        return await self._request(
+            "GET", "me/player/recently-played", limit=limit, after=after, before=before
+        )
+
+
+def track_uri(track_id):
+    return track_id if track_id.startswith("spotify:") else f"spotify:track:{track_id}"
+
+
+def spotify_exception(response):
+    """A failed response as the same SpotifyException spotipy raises"""
+    try:
+        error = response.json().get("error", {})
+        msg, reason = error.get("message"), error.get("reason")
+    except ValueError:
+        msg, reason = response.text or None, None
+    return SpotifyException(
+        response.status_code,
+        -1,
+        f"{response.url}:\n {msg}",
+        reason=reason,
+        headers=response.headers,
+    )
+
+
+class AsyncSpotUserActions:
+    """The core operations of SpotUserActions, for a user we already have"""
+
+    likes_reconcile_period = SpotUserActions.likes_reconcile_period
+    prefetch_concurrency = SpotUserActions.prefetch_workers
+
+    def __init__(self, user: User, client):
+        self.user = user
+        self.auth_manager = get_auth_manager(user)
+        self.spotify = AsyncSpotify(self.auth_manager, client=client)
+
+    async def connect(self):
+        try:
+            await self.spotify.current_user()
+        except SpotifyException as e:
+            raise SpotifyConnectionException(e.msg)
+
+    async def get_spotify_list(self, results, prefetch=False):
+        """Consume the Spotify API paginated results, as an async generator
+        With `prefetch` the pages after the first one are downloaded concurrently
+        """
+        if (
+            prefetch
+            and results["next"]
+            and results.get("total")
+            and results.get("limit")
+        ):
+            limit = results["limit"]
+            next_pages = (
+                page_url(results["next"], offset)
+                for offset in range(results["offset"] + limit, results["total"], limit)
+            )
+            for item in results["items"]:
+                yield item
+            pending = deque()
+            try:
+                for url in next_pages:
+                    pending.append(
+                        asyncio.ensure_future(self.spotify.next(dict(next=url)))
+                    )
+                    if len(pending) >= self.prefetch_concurrency:
+                        for item in (await pending.popleft())["items"]:
+                            yield item
+                while pending:
+                    for item in (await pending.popleft())["items"]:
+                        yield item
+            finally:  # when the consumer stops early, we don't need the other pages
+                for future in pending:
+                    future.cancel()
+            return
+
+        seen_next = deque(maxlen=10)
+        while True:
+            for item in results["items"]:
+                yield item
+            next_page = results["next"]
+            if not next_page:
+                break
+            if next_page in seen_next:
+                raise RuntimeError(
+                    f"Something is wrong - I got {next_page}"
+                    " that I already saw recently"
+                )
+            seen_next.append(next_page)
+            results = await self.spotify.next(results)
+
+    async def liked_songs(self, prefetch=False):
+        results = await self.spotify.current_user_saved_tracks(limit=50)
+        async for liked in self.get_spotify_list(results, prefetch=prefetch):
+            yield liked
+
+    async def recently_played(self, after=None):
+        results = await self.spotify.current_user_recently_played(after=after)
+        async for played in self.get_spotify_list(results):
+            yield played
+
+    async def playlist_tracks(self, playlist_id, prefetch=True):
+        """The playlist tracks - keeping only what the merge needs"""
+        results = await self.spotify.playlist_items(playlist_id)
+        return [
+            dict(added_at=item["added_at"], track=dict(id=item["track"]["id"]))
+            async for item in self.get_spotify_list(results, prefetch=prefetch)
+            if item["track"]
+        ]
+
+    async def msg(self, message, msg_type=None):
+        click.echo(message)
+
+        def save():
+            with write_batch():
+                Message.create(user=self.user, message=message, msg_type=msg_type)
+
+        await run_blocking(save)
+
+    async def get_or_create_playlist(self, name):
+        results = await self.spotify.current_user_playlists()
+        same_name_playlists = [
+            playlist
+            async for playlist in self.get_spotify_list(results, prefetch=True)
+            if playlist["owner"]["id"] == self.user.id and playlist["name"] == name
+        ]
+        if not same_name_playlists:
+            await self.msg(
+                f"Creating a new playlist: {name}", msg_type="playlist-create"
+            )
+            return await self.spotify.user_playlist_create(
+                self.user.id,
+                description="All the songs you like - synced by Spotlike",
+                name=name,
+                public=False,
+            )
+        for duplicated_playlist in same_name_playlists[:-1]:
+            logger.debug(f"Removing duplicated {duplicated_playlist['id']}")
+            await self.spotify.current_user_unfollow_playlist(duplicated_playlist["id"])
+        return same_name_playlists[-1]
+
+    async def collect_likes(self, page_size=50, full=None):
+        """The async version of SpotUserActions.collect_likes"""
+        if full is None:
+            full = await run_blocking(
+                likes_need_reconciliation, self.user, self.likes_reconcile_period
+            )
+        ingest = await run_blocking(LikesIngest, self.user, full)
+        async for page in achunked(self.liked_songs(prefetch=full), page_size):
+            if await run_blocking(ingest.add_page, page):
+                break
+        await run_blocking(ingest.finish)
+        return full
+
+    async def refresh_likes(self, likes_total):
+        """The async version of SpotUserActions.refresh_likes"""
+        if await self.collect_likes():
+            return
+        if likes_total != await run_blocking(stored_likes_count, self.user):
+            await self.collect_likes(full=True)
+
+    async def collect_recent(self, page_size=50):
+        """The async version of SpotUserActions.collect_recent"""
+        ingest = await run_blocking(PlaysIngest, self.user)
+        async for page in achunked(self.recently_played(after=ingest.after), page_size):
+            if await run_blocking(ingest.add_page, page):
+                break
+        await run_blocking(ingest.finish)
+
+    async def sync_liked_with_playlist(self, name, full=True):
+        playlist = await self.get_or_create_playlist(name)
+        sync_state = playlist_sync_state(
+            playlist, await self.spotify.current_user_saved_tracks(limit=1)
+        )
+        last_sync = await run_blocking(
+            SyncState.get_state, self.user, playlist_sync_key(name, full)
+        )
+        if last_sync and last_sync.value == sync_state:
+            logger.debug(f"Nothing changed since the last sync of {name}")
+            return
+
+        playlist_tracks, _ = await asyncio.gather(
+            self.playlist_tracks(playlist["id"], prefetch=full),
+            self.refresh_likes(sync_state["likes_total"]),
+        )
+        likes = await run_blocking(lambda: list(stored_likes(self.user)))
+
+        to_add, to_del = sync_merge(iter(likes), iter(playlist_tracks), full=full)
+        if to_add or to_del:
+            msg = filter(
+                None,
+                [
+                    f"Added {len(to_add)}" if to_add else None,
+                    f"Removed {len(to_del)}" if to_del else None,
+                ],
+            )
+            await self.msg(" / ".join(msg) + " songs", msg_type="synclike")
+
+        for tracks in reverse_block_chunks(to_add, 100):
+            await self.spotify.playlist_add_items(playlist["id"], tracks, position=0)
+        for tracks in reverse_block_chunks(to_del, 100):
+            await self.spotify.playlist_remove_all_occurrences_of_items(
+                playlist["id"], tracks
+            )
+
+        if to_add or to_del:  # we changed the playlist - it has a new snapshot
+            sync_state["snapshot_id"] = (
+                await self.spotify.playlist(playlist["id"], fields="snapshot_id")
+            )["snapshot_id"]
+
+        def save_state():
+            with write_batch():
+                save_playlist_sync(self.user, name, sync_state, full)
+
+        await run_blocking(save_state)
+
+    async def unlike_tracks(self, to_unlike):
+        for tracks in reverse_block_chunks(
+            list(to_unlike), OUTBOX_BATCH_SIZES["unlike"]
+        ):
+            await self.spotify.current_user_saved_tracks_delete(tracks=tracks)
+
+            def forget(tracks=tracks):
+                with write_batch():
+                    Liked.delete().where(
+                        Liked.user == self.user, Liked.track.in_(tracks)
+                    ).execute()
+
+            await run_blocking(forget)
+
+
+async def sync_all_users(users, name="Liked playlist", concurrency=100):
+    """Sync the likes of many users at once - returns the stats of the run"""
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = Counter()
+
+    async def sync_user(user):
+        async with semaphore:
+            act = AsyncSpotUserActions(user, client)
+            try:
+                await act.connect()
+                await act.sync_liked_with_playlist(name)
+                await act.collect_recent()
+                stats["ok"] += 1
+            except SpotifyConnectionException as e:
+                logger.error(f"Cannot connect {user}: {e}")
+                stats["failed"] += 1
+            except Exception:
+                logger.exception(f"Error processing {user}")
+                stats["failed"] += 1
+
+    start = time.monotonic()
+    async with http_client() as client:
+        await asyncio.gather(*(sync_user(user) for user in users))
+    logger.info(
+        f"Synced {len(users)} users in {time.monotonic() - start:.1f}s"
+        f" - {stats['failed']} failed"
+    )
+    return stats
@@ -0,0 +1,88 @@
+"""Micro-benchmark of parse_date: the throughput on the timestamps we ingest,
+compared with trying the formats with strptime one after the other
+
+    python -m benchmarks.dates --count 100000
+"""
+
+import datetime
+import random
+import time
+
+import click
+
+from spottools import (
+    ALLOWED_DATETIME_FORMATS,
+    parse_added_at,
+    parse_date,
+    parse_played_at,
+    parse_release_date,
+)
+
+
+def strptime_parse_date(date_str):
+    """The reference: every format in order, until one matches"""
+    if len(date_str) == 4:
+        date_str += "-01-01"
+    elif len(date_str) == 7:
+        date_str += "-01"
+    date_str = date_str.strip()
+    for date_fmt in ALLOWED_DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(date_str, date_fmt)
+        except ValueError:
+            pass
+    raise ValueError(date_str)
+
+
+def timestamps(count, layout, seed=0):
+    """`count` random timestamps of the last 10 years, in a strftime layout"""
+    rng = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    return [
+        (start + datetime.timedelta(seconds=rng.uniform(0, 10 * 365 * 86400))).strftime(
+            layout
+        )
+        for _ in range(count)
+    ]
+
+
+def release_dates(count, albums=2000, seed=0):
+    """`count` release dates of a library with `albums` albums"""
+    rng = random.Random(seed)
+    dates = [
+        f"{rng.randint(1950, 2024)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"[
+            : rng.choice((4, 7, 10))  # the year, month or day precision
+        ]
+        for _ in range(albums)
+    ]
+    return [rng.choice(dates) for _ in range(count)]
+
+
+def throughput(parse, values):
+    start = time.perf_counter()
+    for value in values:
+        parse(value)
+    return len(values) / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--count", default=100_000, help="The timestamps to parse per case")
+def main(count):
+    """The dates parsed per second, by layout"""
+    cases = (
+        ("added_at", parse_added_at, timestamps(count, "%Y-%m-%dT%H:%M:%SZ")),
+        ("played_at", parse_played_at, timestamps(count, "%Y-%m-%dT%H:%M:%S.%fZ")),
+        ("stored", parse_date, timestamps(count, "%Y-%m-%d %H:%M:%S.%f")),
+        ("release_date", parse_release_date, release_dates(count)),
+    )
+    click.echo(f"{'case':<14} {'strptime/s':>12} {'parse_date/s':>13} {'speedup':>8}")
+    for name, parse, values in cases:
+        reference = throughput(strptime_parse_date, values)
+        fast = throughput(parse, values)
+        click.echo(
+            f"{name:<14} {reference:>12,.0f} {fast:>13,.0f} {fast / reference:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
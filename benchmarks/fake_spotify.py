@@ -0,0 +1,370 @@
+"""A local stand-in of the Spotify Web API, serving a synthetic library:
+the saved tracks, the playlists and the recently played tracks,
+with a configurable latency and throttling (429 every `throttle_every` requests)
+"""
+
+import datetime
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# a real track payload lists the markets where it's available
+MARKETS = [f"{a}{b}" for a in "ABCDEFGHIJKLMN" for b in "ABCDEFGHIJKLM"]
+EPOCH = datetime.datetime(2015, 1, 1)
+
+
+def spotify_date(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def make_track(index, name=None, duration=None):
+    artist = dict(
+        id=f"artist{index % 997}",
+        name=f"Artist {index % 997}",
+        type="artist",
+        uri=f"spotify:artist:artist{index % 997}",
+        external_urls=dict(spotify=f"https://open.spotify.com/artist/{index % 997}"),
+    )
+    album_id = f"album{index % 4999}"
+    return dict(
+        id=f"track{index}",
+        name=name or f"Song {index}",
+        duration_ms=duration or 120000 + index * 7 % 240000,
+        type="track",
+        uri=f"spotify:track:track{index}",
+        popularity=index % 100,
+        explicit=False,
+        available_markets=MARKETS,
+        external_urls=dict(spotify=f"https://open.spotify.com/track/{index}"),
+        artists=[artist],
+        album=dict(
+            id=album_id,
+            name=f"Album {index % 4999}",
+            release_date=f"{1960 + index % 60}-0{1 + index % 9}-1{index % 10}",
+            release_date_precision="day",
+            available_markets=MARKETS,
+            images=[
+                dict(
+                    url=f"https://i.scdn.co/{album_id}/{size}", width=size, height=size
+                )
+                for size in (640, 300, 64)
+            ],
+            artists=[artist],
+        ),
+    )
+
+
+class FakeLibrary:
+    """The Spotify data of a user: `likes` saved tracks (a `duplicates` fraction
+    are other versions of a song already liked) and `plays` recently played
+    """
+
+    def __init__(self, likes, plays=None, duplicates=0.01, seed=0):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tracks = {}
+        self.saved = []  # [(added_at, track_id)] newest first
+        for index in range(likes):
+            original = (
+                rng.randrange(index) if index and rng.random() < duplicates else None
+            )
+            if original is not None:  # the same title and duration of an older like
+                first = self.tracks[f"track{original}"]
+                track = make_track(index, first["name"], first["duration_ms"])
+            else:
+                track = make_track(index)
+            self.tracks[track["id"]] = track
+            self.saved.append((EPOCH + datetime.timedelta(hours=index), track["id"]))
+        self.saved.reverse()
+        self.playlists = {}
+        self.snapshots = Counter()
+        self.plays = []  # [(played_at, track_id)] newest first
+        track_ids = list(self.tracks)
+        last_play = EPOCH + datetime.timedelta(hours=likes)
+        for index in range(likes // 10 if plays is None else plays):
+            played_at = last_play - datetime.timedelta(minutes=4 * index)
+            self.plays.append((played_at, rng.choice(track_ids)))
+
+    def add_likes(self, count):
+        """Like `count` new tracks"""
+        with self.lock:
+            latest = self.saved[0][0] if self.saved else EPOCH
+            for offset in range(count):
+                track = make_track(len(self.tracks))
+                self.tracks[track["id"]] = track
+                added_at = latest + datetime.timedelta(hours=offset + 1)
+                self.saved.insert(0, (added_at, track["id"]))
+
+
+def page(items, url, offset, limit, total):
+    """A Spotify paging object"""
+    parts = urllib.parse.urlsplit(url)
+    query = dict(urllib.parse.parse_qsl(parts.query))
+    query.update(offset=offset + limit, limit=limit)
+    next_url = urllib.parse.urlunsplit(
+        parts._replace(query=urllib.parse.urlencode(query))
+    )
+    return dict(
+        href=url,
+        items=items,
+        offset=offset,
+        limit=limit,
+        total=total,
+        next=next_url if offset + limit < total else None,
+        previous=None,
+    )
+
+
+def track_ids(uris):
+    return [uri.rsplit(":", 1)[-1] for uri in uris]
+
+
+class SpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the real API
+
+    routes = (
+        ("GET", r"/v1/me/?", "me"),
+        ("GET", r"/v1/me/tracks", "saved_tracks"),
+        ("GET", r"/v1/me/(?:tracks|library)/contains", "saved_contains"),
+        ("PUT", r"/v1/me/(tracks|library)", "save_tracks"),
+        ("DELETE", r"/v1/me/(tracks|library)", "unsave_tracks"),
+        ("GET", r"/v1/me/playlists", "playlists"),
+        ("POST", r"/v1/(users/[^/]+|me)/playlists", "create_playlist"),
+        ("DELETE", r"/v1/playlists/([^/]+)/followers", "unfollow_playlist"),
+        ("GET", r"/v1/playlists/([^/]+)", "playlist"),
+        ("GET", r"/v1/playlists/([^/]+)/(?:tracks|items)", "playlist_items"),
+        ("POST", r"/v1/playlists/([^/]+)/(?:tracks|items)", "add_items"),
+        ("DELETE", r"/v1/playlists/([^/]+)/(?:tracks|items)", "remove_items"),
+        ("GET", r"/v1/me/player/recently-played", "recently_played"),
+        ("GET", r"/v1/me/top/tracks", "top_tracks"),
+    )
+
+    def log_message(self, format, *args):
+        pass  # no access log
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        server = self.server
+        parts = urllib.parse.urlsplit(self.path)
+        self.query = dict(urllib.parse.parse_qsl(parts.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        self.payload = json.loads(self.rfile.read(length)) if length else None
+        if server.latency:
+            time.sleep(server.latency)
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, parts.path)
+            if route_method == method and match:
+                break
+        else:
+            return self.respond(404, dict(error=dict(status=404, message="Not found")))
+
+        with server.lock:
+            server.requests[name] += 1
+            throttled = (
+                server.throttle_every
+                and sum(server.requests.values()) % server.throttle_every == 0
+            )
+        if throttled:
+            server.throttled += 1
+            return self.respond(
+                429,
+                dict(error=dict(status=429, message="API rate limit exceeded")),
+                headers={"Retry-After": "0"},
+            )
+        with server.library.lock:
+            body = getattr(self, name)(*match.groups())
+        self.respond(200 if body is not None else 204, body)
+
+    def respond(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    @property
+    def library(self) -> FakeLibrary:
+        return self.server.library
+
+    def url(self):
+        return self.server.url + self.path
+
+    def paginate(self, items, default_limit=20):
+        offset = int(self.query.get("offset", 0))
+        limit = int(self.query.get("limit", default_limit))
+        return page(
+            items[offset : offset + limit], self.url(), offset, limit, len(items)
+        )
+
+    def me(self):
+        return dict(
+            id="benchmark", display_name="Benchmark", email="b@e.com", images=[]
+        )
+
+    def saved_tracks(self):
+        result = self.paginate(self.library.saved)
+        result["items"] = [
+            dict(added_at=spotify_date(added_at), track=self.library.tracks[track_id])
+            for added_at, track_id in result["items"]
+        ]
+        return result
+
+    def saved_contains(self):
+        ids = self.query.get("ids") or self.query.get("uris", "")
+        saved = {track_id for _, track_id in self.library.saved}
+        return [track_id in saved for track_id in track_ids(ids.split(","))]
+
+    def save_tracks(self, _):
+        ids = self.query.get("ids") or self.query.get("uris", "")
+        now = datetime.datetime.utcnow()
+        for track_id in track_ids(ids.split(",")):
+            self.library.saved.insert(0, (now, track_id))
+
+    def unsave_tracks(self, _):
+        ids = self.query.get("ids") or self.query.get("uris", "")
+        removed = set(track_ids(ids.split(",")))
+        self.library.saved = [s for s in self.library.saved if s[1] not in removed]
+
+    def playlist_object(self, playlist):
+        return dict(
+            playlist,
+            snapshot_id=str(self.library.snapshots[playlist["id"]]),
+            tracks=dict(total=len(playlist["items"])),
+            items=None,
+        )
+
+    def playlists(self):
+        result = self.paginate(list(self.library.playlists.values()), 50)
+        result["items"] = [self.playlist_object(p) for p in result["items"]]
+        return result
+
+    def create_playlist(self, _):
+        playlist_id = f"playlist{len(self.library.playlists)}"
+        self.library.playlists[playlist_id] = dict(
+            id=playlist_id,
+            name=self.payload["name"],
+            owner=dict(id="benchmark"),
+            items=[],
+        )
+        return self.playlist_object(self.library.playlists[playlist_id])
+
+    def unfollow_playlist(self, playlist_id):
+        self.library.playlists.pop(playlist_id, None)
+
+    def playlist(self, playlist_id):
+        return self.playlist_object(self.library.playlists[playlist_id])
+
+    def playlist_items(self, playlist_id):
+        result = self.paginate(self.library.playlists[playlist_id]["items"], 100)
+        result["items"] = [
+            dict(added_at=spotify_date(added_at), track=self.library.tracks[track_id])
+            for added_at, track_id in result["items"]
+        ]
+        return result
+
+    def add_items(self, playlist_id):
+        uris = self.payload if isinstance(self.payload, list) else self.payload["uris"]
+        items = self.library.playlists[playlist_id]["items"]
+        position = self.query.get("position")
+        if position is None and isinstance(self.payload, dict):
+            position = self.payload.get("position")
+        position = len(items) if position is None else int(position)
+        now = datetime.datetime.utcnow()
+        items[position:position] = [(now, track_id) for track_id in track_ids(uris)]
+        self.library.snapshots[playlist_id] += 1
+        return dict(snapshot_id=str(self.library.snapshots[playlist_id]))
+
+    def remove_items(self, playlist_id):
+        entries = self.payload.get("items") or self.payload.get("tracks")
+        removed = set(track_ids(entry["uri"] for entry in entries))
+        playlist = self.library.playlists[playlist_id]
+        playlist["items"] = [i for i in playlist["items"] if i[1] not in removed]
+        self.library.snapshots[playlist_id] += 1
+        return dict(snapshot_id=str(self.library.snapshots[playlist_id]))
+
+    def recently_played(self):
+        """The plays newest first, paginated with the `before` cursor"""
+        limit = int(self.query.get("limit", 50))
+        plays = self.library.plays
+        if "after" in self.query:
+            after = from_epoch_ms(int(self.query["after"]))
+            plays = [p for p in plays if p[0] > after]
+        if "before" in self.query:
+            before = from_epoch_ms(int(self.query["before"]))
+            plays = [p for p in plays if p[0] < before]
+        items = plays[:limit]
+        next_url = None
+        if len(plays) > limit:
+            parts = urllib.parse.urlsplit(self.url())
+            query = dict(self.query, before=to_epoch_ms(items[-1][0]))
+            next_url = urllib.parse.urlunsplit(
+                parts._replace(query=urllib.parse.urlencode(query))
+            )
+        return dict(
+            items=[
+                dict(
+                    played_at=played_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                    track=self.library.tracks[track_id],
+                )
+                for played_at, track_id in items
+            ],
+            next=next_url,
+            limit=limit,
+        )
+
+    def top_tracks(self):
+        played = Counter(track_id for _, track_id in self.library.plays)
+        top = [self.library.tracks[track_id] for track_id, _ in played.most_common()]
+        return self.paginate(top)
+
+
+def from_epoch_ms(epoch_ms):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=epoch_ms)
+
+
+def to_epoch_ms(date):
+    return int((date - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    """The fake API, served from a thread: use it as a context manager"""
+
+    daemon_threads = True
+
+    def __init__(self, library, latency=0.0, throttle_every=0):
+        super().__init__(("127.0.0.1", 0), SpotifyHandler)
+        self.library = library
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.throttled = 0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
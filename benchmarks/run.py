@@ -0,0 +1,185 @@
+"""Benchmark the sync paths against the fake Spotify API:
+for every library size we run the jobs of a user on an empty DB, and record
+the wall time, the Spotify requests, the DB queries and the peak memory of every step
+
+    python -m benchmarks.run --sizes 1000,10000,100000 --output results.json
+    python -m benchmarks.run --sizes 1000 --baseline results.json
+
+The peak RSS is the one of the process so far; with --trace-memory we trace
+the peak of the Python allocations of every step - but tracing slows down everything
+"""
+
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+import click
+
+import spotclient
+import store
+from benchmarks.fake_spotify import FakeLibrary, FakeSpotifyServer
+from main import peak_rss_mb, resource
+from spottools import SpotUserActions
+
+logger = logging.getLogger("spotlike.benchmarks")
+
+PLAYLIST = "Liked playlist"
+NEW_LIKES = 10
+
+
+class FakeAuth:
+    """An auth manager with a token the fake API accepts"""
+
+    token_info = {}
+
+    def get_access_token(self, as_dict=False):
+        return "benchmark-token"
+
+
+def steps(act, library):
+    """The benchmarked steps, in order: (name, function)"""
+
+    def collect_new_likes():
+        library.add_likes(NEW_LIKES)
+        act.collect_likes()
+
+    return (
+        ("collect_likes", act.collect_likes),  # the first run: all the likes
+        ("collect_likes_incremental", collect_new_likes),
+        ("sync_playlist", lambda: act.sync_liked_with_playlist(PLAYLIST)),
+        ("sync_playlist_unchanged", lambda: act.sync_liked_with_playlist(PLAYLIST)),
+        ("remove_duplicates", act.remove_liked_duplicates),
+        ("collect_recent", act.collect_recent),
+    )
+
+
+class QueryCounter:
+    """Count the queries run on a database"""
+
+    def __init__(self, database):
+        self.count = 0
+        execute_sql = database.execute_sql
+
+        def counting_execute_sql(*args, **kwargs):
+            self.count += 1
+            return execute_sql(*args, **kwargs)
+
+        database.execute_sql = counting_execute_sql
+
+
+def run_size(size, latency=0.0, throttle_every=0, workdir=None):
+    """Run all the steps on a library of `size` likes - returns the stats per step"""
+    library = FakeLibrary(likes=size)
+    results = []
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp, FakeSpotifyServer(
+        library, latency=latency, throttle_every=throttle_every
+    ) as server:
+        database = store.configure_db(dict(path=os.path.join(tmp, "benchmark.db")))
+        queries = QueryCounter(database)
+        act = SpotUserActions(auth_manager=FakeAuth(), connect=False)
+        act.spotify.prefix = f"{server.url}/v1/"
+        with store.write_batch():
+            act.user = store.User.create(
+                id="benchmark", name="Benchmark", email="b@e.com", tokens={}
+            )
+
+        for name, step in steps(act, library):
+            spotclient.request_stats.reset()
+            start_queries = queries.count
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            step()
+            elapsed = time.perf_counter() - start
+            requests = spotclient.request_stats.snapshot()
+            results.append(
+                dict(
+                    size=size,
+                    step=name,
+                    seconds=round(elapsed, 3),
+                    requests=requests.get("requests", 0),
+                    rate_limited=requests.get("rate_limited", 0),
+                    queries=queries.count - start_queries,
+                    peak_rss_mb=round(peak_rss_mb(), 1) if resource else None,
+                    traced_peak_mb=(
+                        round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+                        if tracemalloc.is_tracing()
+                        else None
+                    ),
+                )
+            )
+        store.db.close()
+    store.configure_db()
+    return results
+
+
+def run(sizes, latency=0.0, throttle_every=0, rate_limit=1000, trace_memory=False):
+    spotclient.rate_limiter.configure(rate_limit)
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        return [
+            result
+            for size in sizes
+            for result in run_size(size, latency=latency, throttle_every=throttle_every)
+        ]
+    finally:
+        tracemalloc.stop()
+
+
+def print_results(results, baseline=None):
+    baseline = {(b["size"], b["step"]): b for b in baseline or ()}
+    click.echo(
+        f"{'size':>7} {'step':<26} {'seconds':>8} {'requests':>8} {'429':>5}"
+        f" {'queries':>8} {'RSS MB':>8} {'traced MB':>9}"
+    )
+    for r in results:
+        line = (
+            f"{r['size']:>7} {r['step']:<26} {r['seconds']:>8.2f} {r['requests']:>8}"
+            f" {r['rate_limited']:>5} {r['queries']:>8} {r['peak_rss_mb'] or '-':>8}"
+            f" {r['traced_peak_mb'] or '-':>9}"
+        )
+        before = baseline.get((r["size"], r["step"]))
+        if before:
+            line += (
+                f"  (x{r['seconds'] / max(before['seconds'], 0.001):.2f} time,"
+                f" {r['requests'] - before['requests']:+} requests,"
+                f" {r['queries'] - before['queries']:+} queries)"
+            )
+        click.echo(line)
+
+
+@click.command()
+@click.option("--sizes", default="1000,10000,100000", help="The library sizes (likes)")
+@click.option("--latency", default=0.0, help="The seconds of latency of every request")
+@click.option("--throttle-every", default=0, help="Answer 429 every N requests")
+@click.option("--rate-limit", default=1000, help="Our requests per second")
+@click.option("--output", type=click.Path(), help="Save the results as JSON")
+@click.option("--baseline", type=click.Path(exists=True), help="Compare with these")
+@click.option(
+    "--trace-memory", is_flag=True, help="Trace the peak memory of every step"
+)
+def main(sizes, latency, throttle_every, rate_limit, output, baseline, trace_memory):
+    """Benchmark the sync paths against a fake Spotify API"""
+    results = run(
+        [int(size) for size in sizes.split(",")],
+        latency=latency,
+        throttle_every=throttle_every,
+        rate_limit=rate_limit,
+        trace_memory=trace_memory,
+    )
+    if baseline:
+        with open(baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,79 @@
+"""Fuzzy matching of the liked songs:
+the same song with a slightly different title ("Song - Remastered 2011", "Song (Live)")
+or a slightly different duration (the album and the compilation versions)
+"""
+
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+# the suffixes telling a version of a song, rather than a different song
+VERSION_MARKERS = (
+    r"(?:\d{4}\s+)?(?:digital(?:ly)?\s+)?remaster(?:ed)?(?:\s+\d{4})?(?:\s+version)?",
+    r"radio\s+edit",
+    r"single\s+(?:version|edit)",
+    r"album\s+version",
+    r"original\s+mix",
+    r"live(?:\s+(?:at|from|in)\s+.*)?",
+    r"mono(?:\s+version)?",
+    r"stereo(?:\s+version)?",
+    r"explicit",
+)
+VERSION_SUFFIX = re.compile(
+    r"\s*(?:-\s*(?:{markers})|[(\[]\s*(?:{markers})\s*[)\]])\s*$".format(
+        markers="|".join(VERSION_MARKERS)
+    ),
+    re.IGNORECASE,
+)
+APOSTROPHES = re.compile(r"['\u2019`]")
+PUNCTUATION = re.compile(r"[^\w\s]")
+SPACES = re.compile(r"\s+")
+
+
+def normalize_title(title):
+    """A matching key for a song title: lowercase, no accents, no punctuation
+    and without the version suffixes
+    """
+    title = unicodedata.normalize("NFKD", title)
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    while True:  # a title can have more suffixes: "Song - Live - Remastered"
+        stripped = VERSION_SUFFIX.sub("", title)
+        if stripped == title or not stripped:
+            break
+        title = stripped
+    title = APOSTROPHES.sub("", title.lower())
+    title = PUNCTUATION.sub(" ", title)
+    return SPACES.sub(" ", title).strip()
+
+
+def find_duplicates(likes, tolerance_ms=2000):
+    """Group the likes that are versions of the same song
+    `likes` are Spotify saved tracks (newest first): the same title once normalized,
+    and a duration within `tolerance_ms`.
+    The durations are bucketed by the tolerance, so every like is compared only
+    with the likes in its bucket and in the two next to it.
+    Returns {(title, duration): [(track_id, added_at), ...]} with the groups
+    having more than one version, in the same order of the likes
+    """
+    groups: List[Tuple[Tuple[str, int], list]] = []
+    buckets: Dict[Tuple[str, int], List[int]] = defaultdict(list)
+    for liked in likes:
+        track = liked["track"]
+        title, duration = normalize_title(track["name"]), track["duration_ms"]
+        bucket = duration // tolerance_ms
+        group_index = next(
+            (
+                index
+                for near_bucket in (bucket - 1, bucket, bucket + 1)
+                for index in buckets.get((title, near_bucket), ())
+                if abs(groups[index][0][1] - duration) <= tolerance_ms
+            ),
+            None,
+        )
+        if group_index is None:
+            group_index = len(groups)
+            groups.append(((track["name"], duration), []))
+            buckets[title, bucket].append(group_index)
+        groups[group_index][1].append((track["id"], liked["added_at"]))
+    return {key: versions for key, versions in groups if len(versions) > 1}
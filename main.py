@@ -1,13 +1,29 @@
 import logging
+import sys
 
 import click
 
 from spottools import SpotUserActions
 
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+def peak_rss_mb():
+    """The peak resident memory of the process, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # in bytes on macOS, in KB elsewhere
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
 
 @click.group()
-def cli():
+@click.pass_context
+def cli(ctx):
     """Spotlike - a bot to ameliorate your Spotify experience"""
+    if resource:
+        ctx.call_on_close(lambda: click.echo(f"Peak memory: {peak_rss_mb():.1f} MB"))
 
 
 @cli.command()
@@ -21,11 +37,23 @@ def sync(name, fast):
 
 
 @cli.command()
-def remove_duplicates():
+@click.option(
+    "--fuzzy",
+    help="Match also the versions of a song (remastered, live...)",
+    default=False,
+    is_flag=True,
+)
+@click.option(
+    "--dry-run",
+    help="Just report the duplicates found - the new likes are still collected",
+    default=False,
+    is_flag=True,
+)
+def remove_duplicates(fuzzy, dry_run):
     """Look for duplicate-likes - keep the oldest"""
     click.echo("Looking for duplicates in your liked songs")
     act = SpotUserActions()
-    act.remove_liked_duplicates()
+    act.remove_liked_duplicates(fuzzy=fuzzy, dry_run=dry_run)
 
 
 @cli.command()
@@ -0,0 +1,122 @@
+"""In-process instrumentation: thread-safe counters and timers with labels,
+exposed in the Prometheus text format and summarized in the logs
+"""
+
+import contextlib
+import threading
+import time
+from collections import Counter
+
+PREFIX = "spotlike_"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return (
+        "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+    )
+
+
+def metric_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Metrics:
+    """Counters and timers, keyed by name and labels.
+    A timer keeps the count, the total and the max of the seconds observed
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.timers = {}
+
+    def incr(self, name, amount=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] += amount
+
+    def observe(self, name, seconds, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """The counters and the timers (count, total, max) as of now"""
+        with self.lock:
+            return (
+                dict(self.counters),
+                {key: tuple(timer) for key, timer in self.timers.items()},
+            )
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def render(self):
+        """The Prometheus text exposition: the counters as `_total`,
+        the timers as summaries (`_count` and `_sum`) plus a `_max` gauge
+        """
+        counters, timers = self.snapshot()
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            metric = f"{PREFIX}{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.extend(
+                f"{metric}{format_labels(labels)} {value}"
+                for (key, labels), value in sorted(counters.items())
+                if key == name
+            )
+        for name in sorted({name for name, _ in timers}):
+            metric = f"{PREFIX}{name}"
+            lines.append(f"# TYPE {metric} summary")
+            for (key, labels), (count, total, _) in sorted(timers.items()):
+                if key == name:
+                    lines.append(f"{metric}_count{format_labels(labels)} {count}")
+                    lines.append(f"{metric}_sum{format_labels(labels)} {total:.6f}")
+            lines.append(f"# TYPE {metric}_max gauge")
+            lines.extend(
+                f"{metric}_max{format_labels(labels)} {longest:.6f}"
+                for (key, labels), (_, _, longest) in sorted(timers.items())
+                if key == name
+            )
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Human-readable lines: the timers, slowest total first, then the counters"""
+        counters, timers = self.snapshot()
+        lines = [
+            f"{name}{format_labels(labels)}: {count} in {total:.2f}s"
+            f" (avg {total / count * 1000:.1f}ms, max {longest * 1000:.1f}ms)"
+            for (name, labels), (count, total, longest) in sorted(
+                timers.items(), key=lambda item: item[1][1], reverse=True
+            )
+        ]
+        lines.extend(
+            f"{name}{format_labels(labels)}: {value:g}"
+            for (name, labels), value in sorted(counters.items())
+        )
+        return lines
+
+
+metrics = Metrics()
@@ -0,0 +1,237 @@
+"""The shared request layer around the Spotify client:
+all the users of the app share one rate limiter,
+every call is retried with backoff, and we count how it's going
+"""
+
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+import requests
+import spotipy
+from spotipy import SpotifyException
+from urllib3.exceptions import NewConnectionError
+
+from metrics import metrics
+
+logger = logging.getLogger("spotlike.spotclient")
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# a retry could apply them twice: we retry them only when they didn't reach Spotify
+NON_IDEMPOTENT_METHODS = {"POST"}
+SPOTIFY_ID = re.compile(r"^[0-9A-Za-z]{22}$")
+
+
+class TokenBucket:
+    """A thread-safe token bucket: `rate` requests per second,
+    in bursts up to `capacity`. When Spotify throttles us, the whole bucket is paused
+    """
+
+    def __init__(self, rate=10, capacity=None):
+        self.lock = threading.Lock()
+        self.configure(rate, capacity)
+
+    def configure(self, rate, capacity=None):
+        with self.lock:
+            self.rate = rate
+            self.capacity = capacity or rate * 2
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+            self.paused_until = 0
+
+    def reserve(self):
+        """Take a token - returns the seconds to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1  # we reserve the token, even if we have to wait for it
+            return max(-self.tokens / self.rate, self.paused_until - now, 0)
+
+    def acquire(self):
+        """Take a token - waiting for it if needed. Returns the seconds waited"""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestStats:
+    """Thread-safe counters of the Spotify calls"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = Counter()
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+
+
+rate_limiter = TokenBucket()
+request_stats = RequestStats()
+
+
+def configure(config):
+    """Set the rate limit from the config"""
+    rate = config.get("SPOTIFY_RATE_LIMIT")
+    if rate:
+        rate_limiter.configure(rate, config.get("SPOTIFY_RATE_BURST"))
+
+
+def retry_delay(attempt, retry_after=None, base=1, cap=60):
+    """How long to wait before the next attempt:
+    what Spotify asked in Retry-After, or an exponential backoff with full jitter
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def endpoint_name(url):
+    """The endpoint of a Spotify URL, for the metrics: no query and no ids
+    "https://api.spotify.com/v1/playlists/37i9dQZF1DXcBWIGoYBM5M/tracks?offset=100"
+    is "playlists/{id}/tracks"
+    """
+    path = urlsplit(url).path.strip("/")
+    if path.startswith("v1/"):
+        path = path[3:]
+    segments = path.split("/")
+    return "/".join(
+        (
+            "{id}"
+            if SPOTIFY_ID.match(segment) or (index and segments[index - 1] == "users")
+            else segment
+        )
+        for index, segment in enumerate(segments)
+    )
+
+
+def get_retry_after(exception):
+    headers = getattr(exception, "headers", None) or {}
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class RetryingClientMixin:
+    """The retry policy shared by the sync and the async Spotify clients"""
+
+    def setup_retries(self, max_retries=8, limiter=None, stats=None):
+        self.max_retries = max_retries
+        self.limiter = limiter or rate_limiter
+        self.stats = stats or request_stats
+
+    def count_request(self, throttled, endpoint=None):
+        if throttled:
+            self.stats.incr("throttle_seconds", throttled)
+            metrics.observe("spotify_throttle_seconds", throttled, endpoint=endpoint)
+        self.stats.incr("requests")
+
+    @staticmethod
+    def not_sent(error):
+        """Whether a request failed before reaching Spotify.
+        The clients know their connection errors: by default it may have been sent
+        """
+        return False
+
+    def next_retry_delay(self, error, attempt, description, endpoint=None, method=None):
+        """Count a failed request, and return how long to wait before retrying it
+        or None when we should give up.
+        The non-idempotent requests are retried only when Spotify throttled them
+        or they didn't reach it: a timeout or a server error may come after the change
+        """
+        retry_after = None
+        status = getattr(error, "http_status", None) or type(error).__name__
+        metrics.incr("spotify_failures", endpoint=endpoint, status=status)
+        throttled = isinstance(error, SpotifyException) and error.http_status == 429
+        if method in NON_IDEMPOTENT_METHODS and not (throttled or self.not_sent(error)):
+            attempt = self.max_retries
+        if isinstance(error, SpotifyException):
+            if error.http_status not in RETRYABLE_STATUSES:
+                attempt = self.max_retries  # no point in retrying
+            elif error.http_status == 429:
+                self.stats.incr("rate_limited")
+                retry_after = get_retry_after(error)
+                if retry_after is not None:
+                    # everybody waits - we are all on the same app
+                    self.limiter.pause(retry_after)
+        if attempt >= self.max_retries:
+            self.stats.incr("errors")
+            metrics.incr("spotify_errors", endpoint=endpoint)
+            return None
+
+        delay = retry_delay(attempt, retry_after)
+        self.stats.incr("retries")
+        self.stats.incr("throttle_seconds", delay)
+        metrics.incr("spotify_retries", endpoint=endpoint)
+        metrics.observe("spotify_throttle_seconds", delay, endpoint=endpoint)
+        logger.warning(
+            f"{description} failed"
+            f" - retry {attempt + 1}/{self.max_retries} in {delay:.1f}s"
+        )
+        return delay
+
+
+class RateLimitedSpotify(RetryingClientMixin, spotipy.Spotify):
+    """A Spotify client going through the shared rate limiter,
+    retrying throttled requests, server errors and connection errors
+    """
+
+    def __init__(self, *args, max_retries=8, limiter=None, stats=None, **kwargs):
+        # we do the retries here - not in the urllib3 adapter
+        kwargs.setdefault("retries", 0)
+        kwargs.setdefault("status_retries", 0)
+        kwargs.setdefault("status_forcelist", ())
+        super().__init__(*args, **kwargs)
+        self.setup_retries(max_retries, limiter, stats)
+
+    @staticmethod
+    def not_sent(error):
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if isinstance(error, requests.exceptions.ConnectionError):
+            # the connection was refused, or the host not found
+            reason = getattr(error.args[0] if error.args else None, "reason", None)
+            return isinstance(reason, NewConnectionError)
+        return False
+
+    def _internal_call(self, method, url, payload, params):
+        endpoint = f"{method} {endpoint_name(url)}"
+        attempt = 0
+        while True:
+            self.count_request(self.limiter.acquire(), endpoint)
+            try:
+                with metrics.timer("spotify_request_seconds", endpoint=endpoint):
+                    return super()._internal_call(method, url, payload, params)
+            except (
+                SpotifyException,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                delay = self.next_retry_delay(
+                    e, attempt, f"{method} {url}", endpoint=endpoint, method=method
+                )
+                if delay is None:
+                    raise
+            attempt += 1
+            time.sleep(delay)
@@ -1,9 +1,14 @@
+import abc
 import datetime
 import json
+import itertools
 import logging
-import time
-from collections import defaultdict, deque
-from functools import partial
+import sys
+import threading
+import urllib.parse
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from typing import Dict, Set
 
 import click
@@ -14,6 +19,9 @@ from peewee import JOIN
 # will get credentials and save them locally
 from spotipy import SpotifyException
 
+from duplicates import find_duplicates
+from spotclient import RateLimitedSpotify
+from stats import play_stats
 from store import (
     User,
     initdb,
@@ -23,9 +31,15 @@ from store import (
     TrackArtist,
     Album,
     Liked,
+    Outbox,
     Play,
     AlbumArtist,
-    db,
+    RecentPlay,
+    SyncState,
+    catalog_cache,
+    group_concat,
+    paginate_keyset,
+    write_batch,
 )
 
 scope = ",".join(
@@ -61,7 +75,7 @@ class StoredSpotifyOauth(spotipy.SpotifyOAuth):
         token_info = self.user.tokens  # get from DB
         # if scopes don't match, then bail
         if "scope" not in token_info or not self._is_scope_subset(
-                self.scope, token_info["scope"]
+            self.scope, token_info["scope"]
         ):
             return None
 
@@ -75,7 +89,8 @@ class StoredSpotifyOauth(spotipy.SpotifyOAuth):
         if not self.user:
             # logger.warning("Skipping tokens save - without a user")
             return
-        self.user.insert_or_update(tokens=token_info)
+        with write_batch():
+            self.user.insert_or_update(tokens=token_info)
 
 
 def get_auth_manager(user=None, redirect_uri="http://localhost:3000"):
@@ -97,71 +112,489 @@ ALLOWED_DATETIME_FORMATS = (
     "%Y-%m",
 )
 
+# the most tracks Spotify accepts in a call, for every outbox action
+OUTBOX_BATCH_SIZES = {"like": 50, "unlike": 50, "add": 100, "remove": 100}
 
-def parse_date(date_str):
-    if isinstance(date_str, str):
+
+def fast_parse_date(date_str):
+    """fromisoformat, on the layouts of ALLOWED_DATETIME_FORMATS it parses the same way:
+    "2020-01-02", "2020-01-02 10:30", "2020-01-02 10:30:00[.fff[fff]]"
+    and "2020-01-02T10:30:00[.fff[fff]]Z". None for anything else
+    """
+    if len(date_str) < 10 or date_str[4] != "-" or date_str[7] != "-":
+        return None
+    if len(date_str) > 10:
+        if date_str[-1] == "Z":
+            date_str, separator = date_str[:-1], "T"
+        else:
+            separator = " "
+        length = len(date_str)
+        if length == 16:
+            if separator == "T":
+                return None
+        elif length not in (19, 23, 26) or date_str[16] != ":":
+            return None
+        elif length > 19 and (date_str[19] != "." or not date_str[20:].isdigit()):
+            return None
+        if date_str[10] != separator or date_str[13] != ":":
+            return None
+    try:
+        parsed = datetime.datetime.fromisoformat(date_str)
+    except ValueError:
+        return None
+    # an offset slipped in: the formats are all naive
+    return parsed if parsed.tzinfo is None else None
+
+
+class DateParser:
+    """Parse the dates in the ALLOWED_DATETIME_FORMATS - a datetime passes through.
+    The common layouts take the fromisoformat path, the others try first
+    the format that worked the last time: a call site keeps seeing the same one,
+    so each has its own parser. The last format is per thread, as the pages
+    are stored from the worker threads
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    @property
+    def last_format(self):
+        return getattr(self.local, "last_format", None)
+
+    def __call__(self, date_str):
+        if not isinstance(date_str, str):
+            return date_str
         if len(date_str) == 4:
             date_str += "-01-01"  # %Y, let's add Jan01
         elif len(date_str) == 7:
             date_str += "-01"  # %Y-%M, let's add the day to be able to parse
         date_str = date_str.strip()
-        for date_fmt in ALLOWED_DATETIME_FORMATS:
+        parsed = fast_parse_date(date_str)
+        if parsed is not None:
+            return parsed
+        last_format = self.last_format
+        formats = ALLOWED_DATETIME_FORMATS
+        if last_format:
+            formats = (last_format, *formats)
+        for date_fmt in formats:
             try:
-                return datetime.datetime.strptime(date_str, date_fmt)
+                parsed = datetime.datetime.strptime(date_str, date_fmt)
             except ValueError:
-                pass
+                continue
+            self.local.last_format = date_fmt
+            return parsed
         raise ValueError(
             f"Invalid date: '{date_str}', please pass a datetime or a string format"
         )
-    return date_str
 
 
-def store_track(track):
-    artists = []
-    for artist in track.get("artists", []):
-        a = Artist().insert_or_update(
-            id=artist["id"],
-            name=artist["name"],
-        )
-        artists.append(a)
-
-    if track.get("album"):
-        album = Album().insert_or_update(
-            id=track["album"]["id"],
-            name=track["album"]["name"],
-            release_date=parse_date(track["album"]["release_date"]),
-            release_date_precision=track["album"]["release_date_precision"],
-            picture=track["album"]["images"][0]["url"]
-            if track["album"]["images"]
-            else None,
+parse_date = DateParser()
+parse_added_at = DateParser()
+parse_played_at = DateParser()
+ITEM_DATE_PARSERS = {"added_at": parse_added_at, "played_at": parse_played_at}
+# the albums of a library share few release dates
+parse_release_date = lru_cache(maxsize=4096)(DateParser())
+
+
+def compact_artists(artists):
+    return [dict(id=artist["id"], name=artist["name"]) for artist in artists]
+
+
+def compact_track(track):
+    """The fields of a Spotify track we use: we drop the rest (markets, images...)
+    as soon as it comes off the wire
+    """
+    album = track.get("album")
+    return dict(
+        id=track["id"],
+        name=track["name"],
+        duration_ms=track["duration_ms"],
+        artists=compact_artists(track.get("artists", [])),
+        album=(
+            dict(
+                id=album["id"],
+                name=album["name"],
+                release_date=album["release_date"],
+                release_date_precision=album["release_date_precision"],
+                images=album["images"][:1],  # we keep only the picture we show
+                artists=compact_artists(album.get("artists", [])),
+            )
+            if album
+            else None
+        ),
+    )
+
+
+def compact_saved(item, date_key="added_at"):
+    """A saved track (or a recently played one with `date_key="played_at"`)"""
+    track = item["track"]
+    return {date_key: item[date_key], "track": compact_track(track) if track else None}
+
+
+def compact_playlist_item(item):
+    """A playlist item - the sync needs just the track id"""
+    track = item["track"]
+    return dict(
+        added_at=item["added_at"],
+        track=dict(id=track["id"]) if track else None,
+    )
+
+
+def project_page(results, project):
+    return dict(results, items=[project(item) for item in results["items"]])
+
+
+# the fields store_tracks writes, per catalog table
+CATALOG_FIELDS = {
+    Artist: ("id", "name"),
+    Album: ("id", "name", "release_date", "release_date_precision", "picture"),
+    AlbumArtist: ("album", "artist"),
+    Track: ("id", "duration", "title", "album"),
+    TrackArtist: ("track", "artist"),
+}
+
+
+def prewarm_catalog_cache():
+    """Fill the catalog cache with the rows in the DB - returns how many"""
+    return catalog_cache.prewarm(CATALOG_FIELDS)
+
+
+def store_tracks(tracks):
+    """Store a batch of Spotify tracks (with their albums and artists)
+    deduping them in memory and doing one bulk upsert per table in a transaction.
+    The rows the catalog cache knows unchanged are skipped.
+    Returns a Counter with the number of rows inserted and changed
+    """
+    artists, albums, album_artists, db_tracks, track_artists = {}, {}, {}, {}, {}
+    for track in tracks:
+        for artist in track.get("artists", []):
+            artists[artist["id"]] = dict(id=artist["id"], name=artist["name"])
+            track_artists[track["id"], artist["id"]] = dict(
+                track=track["id"], artist=artist["id"]
+            )
+
+        album = track.get("album")
+        if album:
+            albums[album["id"]] = dict(
+                id=album["id"],
+                name=album["name"],
+                release_date=parse_release_date(album["release_date"]),
+                release_date_precision=album["release_date_precision"],
+                picture=album["images"][0]["url"] if album["images"] else None,
+            )
+            for artist in album.get("artists", []):
+                artists[artist["id"]] = dict(id=artist["id"], name=artist["name"])
+                album_artists[album["id"], artist["id"]] = dict(
+                    album=album["id"], artist=artist["id"]
+                )
+
+        db_tracks[track["id"]] = dict(
+            id=track["id"],
+            duration=track["duration_ms"],
+            title=track["name"],
+            album=album["id"] if album else None,
         )
-        for artist in track["album"].get("artists", []):
-            a = Artist().insert_or_update(
-                id=artist["id"],
-                name=artist["name"],
+
+    stats = Counter()
+    with write_batch():
+        for Model, rows in (
+            (Artist, artists),
+            (Album, albums),
+            (AlbumArtist, album_artists),
+            (Track, db_tracks),
+            (TrackArtist, track_artists),
+        ):
+            inserted, changed = Model.bulk_upsert(
+                catalog_cache.changed(Model, rows.values())
             )
-            AlbumArtist().insert_or_update(album=album, artist=a)
-    else:
-        album = None
+            stats["inserted"] += inserted
+            stats["changed"] += changed
+    return stats
 
-    t = Track().insert_or_update(
-        id=track["id"],
-        duration=track["duration_ms"],
+
+def store_likes(user, page):
+    """Store a page of saved tracks
+    Returns the Liked rows, how many of them were new and the catalog stats
+    """
+    likes = [
+        dict(
+            track=liked["track"]["id"],
+            user=user.id,
+            date=parse_added_at(liked["added_at"]),
+        )
+        for liked in page
+    ]
+    with write_batch():
+        stats = store_tracks(liked["track"] for liked in page)
+        new_likes, _ = Liked.bulk_upsert(likes)
+    return likes, new_likes, stats
+
+
+def store_plays(user, page):
+    """Store a page of recently played tracks, and their entries in the recent feed
+    Returns how many plays were new and the catalog stats
+    """
+    with write_batch():
+        stats = store_tracks(played["track"] for played in page)
+        new_plays, _ = Play.bulk_upsert(
+            dict(
+                track=played["track"]["id"],
+                user=user.id,
+                date=parse_played_at(played["played_at"]),
+            )
+            for played in page
+        )
+        RecentPlay.bulk_upsert(recent_play(user, played) for played in page)
+    return new_plays, stats
+
+
+def recent_play(user, played):
+    """The recent feed entry of a recently played track"""
+    track = played["track"]
+    album = track.get("album") or {}
+    # the tracks without artists get the album ones
+    artists = track.get("artists") or album.get("artists", [])
+    return dict(
+        user=user.id,
+        date=parse_played_at(played["played_at"]),
+        track=track["id"],
         title=track["name"],
-        album=album,
+        album_id=album.get("id"),
+        album_name=album.get("name"),
+        picture=album["images"][0]["url"] if album.get("images") else None,
+        artists=[dict(id=artist["id"], name=artist["name"]) for artist in artists],
+    )
+
+
+def likes_need_reconciliation(user, period):
+    reconciled = SyncState.get_state(user, "likes_reconciled")
+    return reconciled is None or datetime.datetime.utcnow() - reconciled.date > period
+
+
+def get_watermark(user, name):
+    """The date of the latest item of a stream we stored (None when we have none)"""
+    state = SyncState.get_state(user, name)
+    if state and state.value:
+        return datetime.datetime.fromisoformat(state.value)
+    # the users synced before we had the watermarks
+    model = Liked if name == "likes_watermark" else Play
+    return model.select(peewee.fn.MAX(model.date)).where(model.user == user).scalar()
+
+
+def set_watermark(user, name, date):
+    SyncState.set_state(user, name, date.isoformat())
+
+
+def items_since(items, date_key, watermark):
+    """The items at or after the watermark (all of them without a watermark)
+    and whether we reached it. The items at the watermark may be new:
+    there are more likes in the same second
+    """
+    if watermark is None:
+        return list(items), False
+    parse = ITEM_DATE_PARSERS.get(date_key, parse_date)
+    dated = [(parse(item[date_key]), item) for item in items]
+    return (
+        [item for date, item in dated if date >= watermark],
+        any(date <= watermark for date, _ in dated),
+    )
+
+
+def epoch_ms(date):
+    """A naive UTC datetime as the epoch milliseconds of the Spotify cursors"""
+    return int(date.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+def remove_stale_likes(user, seen_likes):
+    """Remove from the DB the likes that are not on Spotify anymore"""
+    query = Liked.select(Liked.id, Liked.track, Liked.date).where(Liked.user == user)
+    stale = [
+        like_id
+        for like_id, track_id, date in query.tuples().iterator()
+        if (track_id, date) not in seen_likes
+    ]
+    with write_batch():
+        for batch in peewee.chunked(stale, 100):
+            Liked.delete().where(Liked.id.in_(batch)).execute()
+        if stale:  # the playlists synced with these likes have to be synced again
+            SyncState.delete().where(
+                SyncState.user == user, SyncState.name.startswith("playlist_sync:")
+            ).execute()
+        SyncState.set_state(user, "likes_reconciled")
+    if stale:
+        logger.debug(f"Removed {len(stale)} unliked songs")
+
+
+class StreamIngest(abc.ABC):
+    """The incremental ingest of a stream of items, newest first (the likes, the plays):
+    the pages are stored up to the first one reaching the latest item we stored
+    (the watermark) - or all of them when `full`.
+    The sync and the async clients download the pages, and pass them to `add_page`
+    """
+
+    watermark_name = None
+    date_key = None
+    label = None
+
+    def __init__(self, user, full=False):
+        self.user = user
+        self.full = full
+        self.watermark = get_watermark(user, self.watermark_name)
+        self.latest = self.watermark
+        self.added = 0
+        self.stats = Counter()
+
+    def add_page(self, page):
+        """Store the new items of a page - returns True when we reached the watermark"""
+        new_page, reached = (
+            (page, False)
+            if self.full
+            else items_since(page, self.date_key, self.watermark)
+        )
+        if new_page:
+            page_latest = self.store_page(new_page)
+            if self.latest is None or page_latest > self.latest:
+                self.latest = page_latest
+        return reached
+
+    @abc.abstractmethod
+    def store_page(self, items):
+        """Store the new items - returns the date of the latest"""
+
+    def finish(self):
+        if self.latest != self.watermark:
+            # only when all the new items are stored: they come newest first
+            set_watermark(self.user, self.watermark_name, self.latest)
+        if self.added:
+            logger.debug(
+                f"Added {self.added} {self.label}"
+                f" - catalog: {self.stats['inserted']} inserted,"
+                f" {self.stats['changed']} changed"
+            )
+
+
+class LikesIngest(StreamIngest):
+    """The saved tracks: a `full` ingest removes the ones that were unliked"""
+
+    watermark_name = "likes_watermark"
+    date_key = "added_at"
+    label = "likes"
+
+    def __init__(self, user, full=False):
+        super().__init__(user, full)
+        self.seen_likes = set()
+
+    def store_page(self, items):
+        likes, new_likes, page_stats = store_likes(self.user, items)
+        self.added += new_likes
+        self.stats += page_stats
+        if self.full:
+            self.seen_likes.update((like["track"], like["date"]) for like in likes)
+        return max(like["date"] for like in likes)
+
+    def finish(self):
+        super().finish()
+        if self.full:
+            remove_stale_likes(self.user, self.seen_likes)
+
+
+class PlaysIngest(StreamIngest):
+    """The recently played tracks, and their recent feed"""
+
+    watermark_name = "plays_watermark"
+    date_key = "played_at"
+    label = "recent"
+
+    def __init__(self, user, full=False):
+        if not SyncState.get_state(user, "recent_feed_filled"):
+            fill_recent_feed(user)
+        super().__init__(user, full)
+
+    @property
+    def after(self):
+        """The Spotify cursor of the plays after the watermark"""
+        return epoch_ms(self.watermark) if self.watermark else None
+
+    def store_page(self, items):
+        new_plays, page_stats = store_plays(self.user, items)
+        self.added += new_plays
+        self.stats += page_stats
+        return max(parse_played_at(played["played_at"]) for played in items)
+
+
+def liked_duplicates(user, since=None):
+    """The liked songs sharing the same (title, duration)
+    with a song liked after `since`.
+    Returns {(title, duration): [(track_id, added_at), ...]} newest first
+    """
+    new_likes = Liked.select(Liked.track).where(Liked.user == user)
+    if since:
+        new_likes = new_likes.where(Liked.date > since)
+    new_keys = Track.select(Track.title, Track.duration).where(Track.id.in_(new_likes))
+    liked_on = peewee.fn.MAX(Liked.date)
+    query = (
+        Track.select(Track.title, Track.duration, Track.id, liked_on)
+        # the CROSS JOIN keeps the tracks as the outer loop of the query
+        # so we find the duplicates with the (title, duration) index
+        .join(Liked, JOIN.CROSS)
+        .where(
+            Liked.track == Track.id,
+            Liked.user == user,
+            peewee.Tuple(Track.title, Track.duration).in_(new_keys),
+        )
+        .group_by(Track.id)
+        .order_by(Track.title, Track.duration, liked_on.desc())
+        .tuples()
+    )
+    track_versions: Dict[tuple, list] = defaultdict(list)
+    for title, duration, track_id, date in query:
+        track_versions[title, duration].append(
+            (track_id, date.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        )
+    return {
+        key: versions for key, versions in track_versions.items() if len(versions) > 1
+    }
+
+
+def stored_likes_count(user):
+    """How many tracks the user likes, for what we know"""
+    return Liked.select(Liked.track).where(Liked.user == user).distinct().count()
+
+
+def stored_likes(user):
+    """The likes we have in the DB, in the same shape Spotify gives them"""
+    query = (
+        Liked.select(Liked.date, Track.id, Track.title, Track.duration)
+        .join(Track)
+        .where(Liked.user == user)
+        .order_by(Liked.date.desc())
+        .tuples()
     )
-    for a in artists:
-        TrackArtist().insert_or_update(track=t, artist=a)
-    return t
+    seen = set()
+    for date, track_id, title, duration in query.iterator():
+        if track_id in seen:
+            continue  # an older like of something liked again
+        seen.add(track_id)
+        yield dict(
+            added_at=date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            track=dict(id=track_id, name=title, duration_ms=duration),
+        )
 
 
 class SpotUserActions:
+    # how often we download all the likes, to catch the unlikes
+    likes_reconcile_period = datetime.timedelta(days=7)
+    outbox_max_batches = None  # the Spotify calls per drain of the outbox
+    outbox_max_attempts = 5
+    # how many pages we download concurrently, when prefetching
+    prefetch_workers = 4
+
     def __init__(
-            self,
-            user=None,
-            auth_manager=None,
-            connect=True,
-            redirect_uri="http://localhost:3000",
+        self,
+        user=None,
+        auth_manager=None,
+        connect=True,
+        redirect_uri="http://localhost:3000",
     ):
         initdb()
         # we use a custom client_credentials_manager that writes in the DB
@@ -169,7 +602,7 @@ class SpotUserActions:
             user, redirect_uri=redirect_uri
         )
 
-        self.spotify = spotipy.Spotify(
+        self.spotify = RateLimitedSpotify(
             auth_manager=self.auth_manager, requests_timeout=30
         )
 
@@ -180,32 +613,49 @@ class SpotUserActions:
                 raise SpotifyConnectionException(e.msg)
 
             # we are initialized - let's save the user
-            self.user = User(id=spotify_user["id"]).insert_or_update(
-                **dict(
-                    name=spotify_user["display_name"],
-                    email=spotify_user["email"],
-                    picture=spotify_user["images"][0]["url"]
-                    if spotify_user["images"]
-                    else None,
-                    tokens=self.auth_manager.token_info,
+            with write_batch():
+                self.user = User(id=spotify_user["id"]).insert_or_update(
+                    **dict(
+                        name=spotify_user["display_name"],
+                        email=spotify_user["email"],
+                        picture=(
+                            spotify_user["images"][0]["url"]
+                            if spotify_user["images"]
+                            else None
+                        ),
+                        tokens=self.auth_manager.token_info,
+                    )
                 )
-            )
 
             if user is None:
                 # we didn't have the user - so we save the tokens now
                 self.auth_manager.user = self.user
-            if getattr(self, "_new", False):
+            if self.user._new:
                 self.msg("Sign up successful", msg_type="signup")
 
-    def get_spotify_list(self, results):
-        """A generic method to consume the Spotify API paginated results"""
+    def get_spotify_list(self, results, prefetch=False, project=None):
+        """A generic method to consume the Spotify API paginated results
+        With `prefetch` the following pages are downloaded concurrently:
+        the first page tells us the total, so we know all the other offsets.
+        With `project` the items are reduced (with project(item)) as soon as we get them
+        """
+        if project:
+            results = project_page(results, project)
+        if (
+            prefetch
+            and results["next"]
+            and results.get("total")
+            and results.get("limit")
+        ):
+            yield from self.prefetch_spotify_list(results, project)
+            return
+
         seen_next = deque(maxlen=10)
         while True:
             logger.debug(
                 f"Got {results.get('offset', 0) + len(results['items'])}/{results.get('total', 'unknown')} items"
             )
-            for item in results["items"]:
-                yield item
+            yield from results["items"]
             next_page = results["next"]
             if next_page:
                 if next_page in seen_next:
@@ -214,28 +664,59 @@ class SpotUserActions:
                         f"Something is wrong - I got {next_page} that I already saw recently: {all_but_items}"
                     )
                 seen_next.append(next_page)
-                attempts = 10
-                while attempts:
-                    try:
-                        results = self.spotify.next(results)
-                        break
-                    except spotipy.exceptions.SpotifyException as e:
-                        logger.error(
-                            f"Got an error {e} - waiting and retrying other {attempts} times")
-                        time.sleep(5)
-                        attempts -= 1
+                results = self.get_page(next_page, project)
             else:
                 break
 
+    def prefetch_spotify_list(self, results, project=None):
+        """Yield all the items in order, fetching the next pages with a bounded pool"""
+        limit = results["limit"]
+        next_pages = (
+            page_url(results["next"], offset)
+            for offset in range(results["offset"] + limit, results["total"], limit)
+        )
+        yield from results["items"]
+
+        with ThreadPoolExecutor(max_workers=self.prefetch_workers) as pool:
+            pending = deque(
+                pool.submit(self.get_page, url, project)
+                for url in itertools.islice(next_pages, self.prefetch_workers * 2)
+            )
+            try:
+                while pending:
+                    results = pending.popleft().result()
+                    next_page = next(next_pages, None)
+                    if next_page:
+                        pending.append(pool.submit(self.get_page, next_page, project))
+                    logger.debug(
+                        f"Got {results['offset'] + len(results['items'])}"
+                        f"/{results['total']} items"
+                    )
+                    yield from results["items"]
+            finally:  # when the consumer stops early, we don't need the other pages
+                for future in pending:
+                    future.cancel()
+
+    def get_page(self, url, project=None):
+        # the retries are done by the RateLimitedSpotify client
+        results = self.spotify.next(dict(next=url))
+        # the prefetched pages wait in the queue already reduced
+        return project_page(results, project) if project else results
+
     # @ttl_cache(ttl=1 * 60)  # cached for a minute
     def get_all_playlists(self):
         """Return all the playlists of the user"""
-        return [p for p in self.get_spotify_list(self.spotify.current_user_playlists())]
+        return [
+            p
+            for p in self.get_spotify_list(
+                self.spotify.current_user_playlists(), prefetch=True
+            )
+        ]
 
     def filter_own_playlists(self, playlists):
         for playlist in playlists:
             if (
-                    playlist["owner"]["id"] == self.user.id
+                playlist["owner"]["id"] == self.user.id
             ):  # get only the one owned by the user
                 yield playlist
 
@@ -276,11 +757,32 @@ class SpotUserActions:
         when it's not needed.
         """
         playlist = self.get_or_create_playlist(name)
-        # we have these two iterators
+        pending = SyncState.get_state(self.user, f"playlist_pending:{name}")
+        if pending and pending.value:
+            logger.debug(f"Resuming the interrupted sync of {name}")
+            sync_state = dict(pending.value)
+            pending_full = sync_state.pop("full", False)
+            return self.finish_playlist_sync(
+                name, playlist["id"], sync_state, full=pending_full, resumed=True
+            )
+
+        # when neither the playlist nor the likes changed since the last sync
+        # there's nothing to do: we don't even download the playlist
+        sync_state = playlist_sync_state(
+            playlist, self.spotify.current_user_saved_tracks(limit=1)
+        )
+        last_sync = SyncState.get_state(self.user, playlist_sync_key(name, full))
+        if last_sync and last_sync.value == sync_state:
+            logger.debug(f"Nothing changed since the last sync of {name}")
+            return
+
+        # we have these two iterators - the merge consumes them as streams
         playlist_tracks = self.get_spotify_list(
-            self.spotify.playlist_items(playlist["id"], additional_types=("track",))
+            self.spotify.playlist_items(playlist["id"], additional_types=("track",)),
+            prefetch=full,
+            project=compact_playlist_item,
         )
-        likes = self.cached_likes()
+        likes = self.likes_stream(likes_total=sync_state["likes_total"])
 
         to_add, to_del = sync_merge(likes, playlist_tracks, full=full)
 
@@ -294,115 +796,299 @@ class SpotUserActions:
             )
             self.msg(" / ".join(msg) + " songs", msg_type="synclike")
 
-        # we add and remove all the needed tracks
-        for all_tracks, method in (
-                (to_add, partial(self.spotify.playlist_add_items, position=0)),
-                (to_del, self.spotify.playlist_remove_all_occurrences_of_items),
-        ):
-            # we do our operations in chunks of 100 tracks
-            for tracks in reverse_block_chunks(all_tracks, 100):
-                method(
-                    playlist["id"],
-                    tracks,
-                )
+        # the changes go to the outbox, with the state we sync to:
+        # if we are interrupted, the next run sends them without redoing the diff
+        with write_batch():
+            Outbox.enqueue(self.user, "add", to_add, playlist=playlist["id"])
+            Outbox.enqueue(self.user, "remove", to_del, playlist=playlist["id"])
+            SyncState.set_state(
+                self.user, f"playlist_pending:{name}", dict(sync_state, full=full)
+            )
+        self.finish_playlist_sync(name, playlist["id"], sync_state, full=full)
+
+    def finish_playlist_sync(
+        self, name, playlist_id, sync_state, full=True, resumed=False
+    ):
+        """Send the pending changes of the playlist, and save the state we synced to.
+        When `resumed` the changes may have been sent already, by another drain
+        """
+        pending = Outbox.select().where(
+            Outbox.user == self.user, Outbox.playlist == playlist_id
+        )
+        changed = pending.exists()
+        if not self.drain_outbox(playlist=playlist_id):
+            return  # we'll resume in the next run
+        if changed or resumed:  # we changed the playlist - it has a new snapshot
+            sync_state["snapshot_id"] = self.spotify.playlist(
+                playlist_id, fields="snapshot_id"
+            )["snapshot_id"]
+        with write_batch():
+            save_playlist_sync(self.user, name, sync_state, full)
+            SyncState.set_state(self.user, f"playlist_pending:{name}")
+
+    def outbox_sender(self, action, playlist_id):
+        """The Spotify call sending a batch of tracks of an outbox action"""
+        if action == "like":
+            return lambda tracks: self.spotify.current_user_saved_tracks_add(tracks)
+        if action == "unlike":
+            return lambda tracks: self.spotify.current_user_saved_tracks_delete(tracks)
+        if action == "add":
+            return partial(self.spotify.playlist_add_items, playlist_id, position=0)
+        if action == "remove":
+            return partial(
+                self.spotify.playlist_remove_all_occurrences_of_items, playlist_id
+            )
+        raise ValueError(f"Unknown outbox action: {action}")
+
+    def drain_outbox(self, playlist=None, max_batches=None):
+        """Send the pending changes, in the largest batches Spotify accepts.
+        With `playlist` only the ones of a playlist ("" for the saved tracks).
+        A batch failing (after the client retries) stays in the outbox for the next run
+        - until it fails `outbox_max_attempts` times.
+        Returns True when everything was sent
+        """
+        if max_batches is None:
+            max_batches = self.outbox_max_batches
+        query = Outbox.select().where(Outbox.user == self.user).order_by(Outbox.id)
+        if playlist is not None:
+            query = query.where(Outbox.playlist == playlist)
+        pending: Dict[tuple, list] = defaultdict(list)
+        for change in query:
+            pending[change.playlist, change.action].append(change)
+
+        batches = 0
+        for (playlist_id, action), changes in pending.items():
+            send = self.outbox_sender(action, playlist_id)
+            batch_size = OUTBOX_BATCH_SIZES[action]
+            if action == "add":
+                # we add on top: starting from the last ones we keep the order
+                chunks = reverse_block_chunks(changes, batch_size)
+            else:
+                chunks = peewee.chunked(changes, batch_size)
+            for chunk in chunks:
+                if max_batches is not None and batches >= max_batches:
+                    return False
+                batches += 1
+                ids = [change.id for change in chunk]
+                tracks = [change.track for change in chunk]
+                try:
+                    send(tracks)
+                except SpotifyException as e:
+                    if self.outbox_failed(ids, e) and playlist_id:
+                        # the playlist misses the changes we gave up: diff it again
+                        with write_batch():
+                            forget_playlist_sync(self.user, playlist_id)
+                    return False
+                with write_batch():
+                    Outbox.delete().where(Outbox.id.in_(ids)).execute()
+                    if action == "unlike":
+                        Liked.delete().where(
+                            Liked.user == self.user, Liked.track.in_(tracks)
+                        ).execute()
+        return True
+
+    def outbox_failed(self, ids, error):
+        """Count a failed attempt of the changes - returns how many we gave up"""
+        logger.warning(f"Outbox batch of {len(ids)} changes failed: {error}")
+        with write_batch():
+            Outbox.update(attempts=Outbox.attempts + 1).where(
+                Outbox.id.in_(ids)
+            ).execute()
+            dropped = (
+                Outbox.delete()
+                .where(Outbox.id.in_(ids), Outbox.attempts >= self.outbox_max_attempts)
+                .execute()
+            )
+        if dropped:
+            logger.error(f"Gave up sending {dropped} changes of {self.user}")
+        return dropped
+
+    def refresh_likes(self, likes_total=None):
+        """Collect the new likes - and all of them when Spotify counts a different
+        number of likes than we have: something was unliked since the last
+        reconciliation.
+        `likes_total` is the count on Spotify, when we already know it
+        """
+        if self.collect_likes():
+            return  # we just went through all of them
+        if likes_total is None:
+            likes_total = self.spotify.current_user_saved_tracks(limit=1)["total"]
+        stored_total = stored_likes_count(self.user)
+        if likes_total != stored_total:
+            logger.debug(
+                f"{likes_total} likes on Spotify, {stored_total} stored - reconciling"
+            )
+            self.collect_likes(full=True)
 
     def cached_likes(self):
-        # TODO: This is enormous
-        likes = list(self.liked_songs())
+        """The user likes, newest first:
+        we fetch from Spotify only the new ones, all the rest comes from the DB"""
+        self.refresh_likes()
+        likes = list(self.stored_likes())
         self.cached_likes = lambda: likes  # replace the property
         return likes
 
-    def liked_songs(self):
+    def stored_likes(self):
+        return stored_likes(self.user)
+
+    def likes_stream(self, likes_total=None):
+        """The likes, newest first: from the DB, unless we have them in memory"""
+        if "cached_likes" in vars(self):
+            return iter(self.cached_likes())
+        self.refresh_likes(likes_total)
+        return self.stored_likes()
+
+    def liked_songs(self, prefetch=False):
         logger.debug("Getting user likes")
         yield from self.get_spotify_list(
-            self.spotify.current_user_saved_tracks(limit=50)
+            self.spotify.current_user_saved_tracks(limit=50),
+            prefetch=prefetch,
+            project=compact_saved,
         )
 
-    def remove_liked_duplicates(self):
-        track_versions: Dict[str:list] = defaultdict(
-            list
-        )  # track key - list of (track_id, date)
-        # we keep the date when a song was liked - so we can show it to the user
-        for liked in self.cached_likes():
-            track_id = liked["track"]["id"]
-            track_duration = liked["track"]["duration_ms"]
-            track_name = liked["track"]["name"]
+    def remove_liked_duplicates(self, fuzzy=False, dry_run=False):
+        """Unlike the duplicates of the new likes - keeping the oldest version
+        The duplicates are searched in the DB,
+        only for the songs liked since the last check.
+        With `fuzzy` we match also the versions of a song (remastered, live...)
+        and the durations differing of a couple of seconds.
+        With `dry_run` we just return what we would unlike:
+        the new likes are still collected, but nothing is unliked or forgotten.
+        Returns the duplicates found {(title, duration): [(track_id, added_at), ...]}
+        """
+        self.refresh_likes()
+        # the fuzzy matching has its own checkpoint: it finds more duplicates
+        checkpoint = "fuzzy_duplicates_checked" if fuzzy else "duplicates_checked"
+        checked = SyncState.get_state(self.user, checkpoint)
+        since = parse_date(checked.value) if checked and checked.value else None
+        latest_like = (
+            Liked.select(peewee.fn.MAX(Liked.date))
+            .where(Liked.user == self.user)
+            .scalar()
+        )
 
-            key = track_name, track_duration
-            track_versions[key].append((track_id, liked["added_at"]))
+        if fuzzy:
+            found = find_duplicates(self.stored_likes())
+            if since:  # we care only about the groups with some new like
+                found = {
+                    key: versions
+                    for key, versions in found.items()
+                    if parse_date(versions[0][1]) > since
+                }
+        else:
+            found = liked_duplicates(self.user, since)
+        found = self.still_liked_versions(found, forget_gone=not dry_run)
 
         to_unlike = set()
         messages = []
-        for key, versions in track_versions.items():
-            if len(versions) > 1:
-                duplicates = versions[:-1]  # all but the last
-                messages.append(
-                    f"Found a duplicate for {key} - removing {len(duplicates)}"
-                    f" - liked on {[date for dup_id, date in versions]}"
-                )
-                to_unlike |= set(dup_id for dup_id, date in duplicates)
+        for key, versions in found.items():
+            duplicates = versions[:-1]  # all but the last
+            messages.append(
+                f"Found a duplicate for {key} - removing {len(duplicates)}"
+                f" - liked on {[date for dup_id, date in versions]}"
+            )
+            to_unlike |= set(dup_id for dup_id, date in duplicates)
+        if dry_run:
+            for message in messages:
+                click.echo(message)
+            return found
         if messages:
             self.msg("\n".join(messages), msg_type="duplicate")
-        if to_unlike:
-            self.unlike_tracks(to_unlike)
+        if to_unlike and not self.unlike_tracks(to_unlike):
+            return found  # the duplicates are checked again in the next run
+        with write_batch():
+            SyncState.set_state(
+                self.user, checkpoint, str(latest_like) if latest_like else None
+            )
+        return found
+
+    def still_liked_versions(self, found, forget_gone=True):
+        """The duplicates still liked on Spotify: the likes we stored can be unliked
+        since we collected them, and we must not keep a version that is gone.
+        With `forget_gone` the ones gone are removed from the DB
+        """
+        candidates = sorted(
+            {track_id for versions in found.values() for track_id, _ in versions}
+        )
+        liked = set()
+        for chunk in peewee.chunked(candidates, OUTBOX_BATCH_SIZES["like"]):
+            contains = self.spotify.current_user_saved_tracks_contains(chunk)
+            liked.update(track_id for track_id, saved in zip(chunk, contains) if saved)
+        gone = [track_id for track_id in candidates if track_id not in liked]
+        if gone and forget_gone:
+            logger.debug(f"{len(gone)} of the duplicates are not liked anymore")
+            with write_batch():
+                Liked.delete().where(
+                    Liked.user == self.user, Liked.track.in_(gone)
+                ).execute()
+        still_liked = {
+            key: [version for version in versions if version[0] in liked]
+            for key, versions in found.items()
+        }
+        return {
+            key: versions for key, versions in still_liked.items() if len(versions) > 1
+        }
 
     def unlike_tracks(self, to_unlike):
+        """Unlike the tracks - returns True when Spotify got all the changes"""
         logger.debug(f"Unlike {len(to_unlike)} songs")
-
-        for tracks in reverse_block_chunks(list(to_unlike), 100):
-            self.spotify.current_user_saved_tracks_delete(
-                tracks=tracks,
-            )
-        if isinstance(self.cached_likes, list):
+        with write_batch():
+            Outbox.enqueue(self.user, "unlike", to_unlike)
+        sent = self.drain_outbox(playlist="")
+        if "cached_likes" in vars(self):
             # filter the unliked_tracks
-            self.cached_likes = [
-                track for track in self.cached_likes if track not in to_unlike
+            likes = [
+                liked
+                for liked in self.cached_likes()
+                if liked["track"]["id"] not in to_unlike
             ]
+            self.cached_likes = lambda: likes
+        return sent
 
     def recently_played(self, after=None):
-        for played in self.get_spotify_list(
-                self.spotify.current_user_recently_played()
-        ):
-            yield played
+        """The recently played tracks - the ones after `after` (epoch ms) if given"""
+        yield from self.get_spotify_list(
+            self.spotify.current_user_recently_played(after=after),
+            project=partial(compact_saved, date_key="played_at"),
+        )
 
     def auto_like_recurrent(self, played_times=5, day_period=30, store=True):
-        """Autolike songs played at least `played_times` times over the `day_period`"""
-        check_history_from = datetime.datetime.utcnow() - datetime.timedelta(
-            days=day_period
+        """Autolike songs played at least `played_times` times over the `day_period`
+        and the recent top tracks. Without `store` we just return them.
+        Returns the ids of the tracks to like
+        """
+        self.collect_recent()
+        self.collect_likes()
+        recurrent = play_stats(
+            self.user,
+            "track",
+            windows=(day_period,),
+            min_plays=played_times,
+            limit=None,
+        )
+        to_like = {track["id"] for track in recurrent}
+        # the Spotify top list knows also about the plays we didn't collect
+        to_like.update(
+            track["id"]
+            for track in self.get_spotify_list(
+                self.spotify.current_user_top_tracks(time_range="short_term")
+            )
+        )
+        liked = Liked.select(Liked.track).where(
+            Liked.user == self.user, Liked.track.in_(list(to_like))
         )
-        as_timestamp = int(check_history_from.timestamp() * 1000)  # in ms
-        recently_played: Dict[str, Dict] = {}
-        scanned = 0
-
-        # we collect recent tracks in two ways - via the spotify top list - and via the recently played ones
-        track_collecting_methods = (
-            partial(self.spotify.current_user_top_tracks, time_range="short_term"),
-            partial(self.spotify.current_user_recently_played, after=as_timestamp),
+        to_like -= {track_id for track_id, in liked.tuples()}
+        logger.debug(
+            f"{len(recurrent)} songs played at least {played_times} times"
+            f" in {day_period} days - {len(to_like)} to like"
         )
 
-        to_like = set()
-
-        for track_collecting_method in track_collecting_methods:
-            for played in self.get_spotify_list(track_collecting_method()):
-                scanned += 1
-                if played.get("type") == "track":  # this is a top-track we just add it
-                    logger.debug(f"Track {played['name']} is a recent top")
-                    to_like.add(played["id"])
-                else:
-                    track_id = played["track"]["id"]
-                    played_at = played["played_at"]
-                    if track_id not in recently_played:
-                        recently_played[track_id] = dict(
-                            name=played["track"]["name"], play_history=set()
-                        )
-                    recently_played[track_id]["play_history"].add(played_at)
-
-        for track_id, desc in recently_played.items():
-            if len(desc["play_history"]) >= played_times:
-                logger.debug("Recently played several", desc)
-                to_like.add(track_id)
-
-        logger.debug(f"Scanned {scanned} songs - recurrent {len(to_like)}")
+        if store and to_like:
+            with write_batch():
+                Outbox.enqueue(self.user, "like", sorted(to_like))
+            self.drain_outbox(playlist="")
+            self.msg(f"Liked {len(to_like)} songs you played often")
+        return to_like
 
     def msg(self, message, msg_type=None):
         click.echo(message)
@@ -411,41 +1097,33 @@ class SpotUserActions:
             message=message,
             msg_type=msg_type,
         )
-        message.save()
-
-    def collect_likes(self):
-        added = 0
-        with db.atomic():
-            for liked in self.cached_likes():
-                track = store_track(liked["track"])
-                try:
-                    like = Liked(
-                        track=track, user=self.user, date=parse_date(liked["added_at"])
-                    )
-                    like.save(force_insert=True)
-                    added += 1
-                except peewee.IntegrityError:
-                    break
-        if added:
-            logger.debug(f"Added {added} likes")
-
-    def collect_recent(self):
-        added = 0
-        with db.atomic():
-            for played in self.recently_played():
-                track = store_track(played["track"])
-
-                try:
-                    Play(
-                        track=track,
-                        user=self.user,
-                        date=parse_date(played["played_at"]),
-                    ).save(force_insert=True)
-                    added += 1
-                except peewee.IntegrityError:
-                    break
-        if added:
-            logger.debug(f"Added {added} recent")
+        with write_batch():
+            message.save()
+
+    def collect_likes(self, page_size=50, full=None):
+        """Store the new likes: the ones since the latest like we stored (the watermark)
+        stopping at the first page reaching it.
+        From time to time (or when `full`) we go through all of them,
+        and remove the ones that were unliked.
+        Returns True when we went through all of them
+        """
+        if full is None:
+            full = likes_need_reconciliation(self.user, self.likes_reconcile_period)
+        ingest = LikesIngest(self.user, full)
+        # when incremental we usually stop at the first page, so we don't prefetch
+        for page in peewee.chunked(self.liked_songs(prefetch=full), page_size):
+            if ingest.add_page(page):
+                break
+        ingest.finish()
+        return full
+
+    def collect_recent(self, page_size=50):
+        """Store the tracks played since the latest play we stored (the watermark)"""
+        ingest = PlaysIngest(self.user)
+        for page in peewee.chunked(self.recently_played(after=ingest.after), page_size):
+            if ingest.add_page(page):
+                break
+        ingest.finish()
 
 
 def reverse_block_chunks(haystack: list, size):
@@ -457,18 +1135,77 @@ def reverse_block_chunks(haystack: list, size):
         start, end = max(0, start - size), start
 
 
+def page_url(url, offset):
+    """The url of a Spotify paginated list, at a given offset"""
+    parts = urllib.parse.urlsplit(url)
+    query = dict(urllib.parse.parse_qsl(parts.query))
+    query["offset"] = offset
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+
+def playlist_sync_key(name, full):
+    """The state of the last sync of a playlist, per mode:
+    a fast sync doesn't remove the unliked songs, so a full sync can't trust it
+    """
+    return f"playlist_sync:{name}:{'full' if full else 'fast'}"
+
+
+def save_playlist_sync(user, name, sync_state, full):
+    """Record the state we synced to - a full sync brings the fast one up to date too"""
+    for mode in (True, False) if full else (False,):
+        SyncState.set_state(user, playlist_sync_key(name, mode), sync_state)
+
+
+def forget_playlist_sync(user, playlist_id):
+    """Forget the syncs of a playlist, the pending one too: the next sync diffs it"""
+    states = SyncState.select().where(
+        SyncState.user == user, SyncState.name.startswith("playlist_")
+    )
+    names = [
+        state.name
+        for state in states
+        if state.value and state.value.get("playlist_id") == playlist_id
+    ]
+    if names:
+        SyncState.delete().where(
+            SyncState.user == user, SyncState.name.in_(names)
+        ).execute()
+
+
+def playlist_sync_state(playlist, likes_head):
+    """What we need to know, to tell if a playlist sync is needed:
+    the playlist snapshot, and the count and the latest of the likes
+    `likes_head` is the first page of the saved tracks
+    """
+    return dict(
+        playlist_id=playlist["id"],
+        snapshot_id=playlist["snapshot_id"],
+        likes_total=likes_head["total"],
+        latest_like=likes_head["items"][0]["added_at"] if likes_head["items"] else None,
+    )
+
+
+def track_ids(items):
+    """Project a stream of Spotify items (likes, playlist tracks...) to their track ids
+    interned: the same id in the likes and in the playlist is stored once
+    """
+    for item in items:
+        if item["track"]:  # removed tracks in playlists have no track
+            yield sys.intern(item["track"]["id"])
+
+
 def sync_merge_full(likes, playlist_tracks):
     """A full-sync, iterating all likes and all the playlist_tracks
     There's no way around to avoid a full-iteration sync from now and then
     Because it's possible to unlike old songs - and that leaves no traces
+    Both are consumed as streams, keeping only the track ids in memory
     """
-    likes_ids = [t["track"]["id"] for t in likes]  # here we care about the order
-    playlist_ids = set(
-        [t["track"]["id"] for t in playlist_tracks]
-    )  # we don't care about the order
+    likes_ids = list(track_ids(likes))  # here we care about the order
+    playlist_ids = set(track_ids(playlist_tracks))  # we don't care about the order
 
     to_add = [t for t in likes_ids if t not in playlist_ids]
-    to_del = list(playlist_ids - set(likes_ids))
+    playlist_ids.difference_update(likes_ids)
+    to_del = list(playlist_ids)
     return to_add, to_del
 
 
@@ -484,19 +1221,19 @@ def sync_merge_fast(likes, playlist_tracks):
     while True:
         # let's add songs until we find something already synced or we find something sinced before the current like
         if (
-                liked
-                and in_playlist
-                and (
+            liked
+            and in_playlist
+            and (
                 liked["track"]["id"] != in_playlist["track"]["id"]
                 and in_playlist["added_at"] <= liked["added_at"]
-        )
+            )
         ):
             to_add.append(liked["track"]["id"])
             liked = next(likes, None)
             continue
 
         if liked and (
-                not in_playlist or liked["track"]["id"] != in_playlist["track"]["id"]
+            not in_playlist or liked["track"]["id"] != in_playlist["track"]["id"]
         ):
             # if what we have
             logger.info(f"Adding the non-liked {liked['track']['name']}")
@@ -518,14 +1255,14 @@ def sync_merge(likes, playlist_tracks, full=True):
 
 def get_recent_query(user):
     artist_join_predicate = (TrackArtist.artist == Artist.id) | (
-            (~TrackArtist.artist) & (AlbumArtist.artist == Artist.id)
+        TrackArtist.artist.is_null() & (AlbumArtist.artist == Artist.id)
     )
 
     def str_to_list(concat_str):
-        return concat_str.split(",")
+        return concat_str.split(",") if concat_str else []
 
-    artist_ids = peewee.fn.GROUP_CONCAT(Artist.id).python_value(str_to_list)
-    artist_names = peewee.fn.GROUP_CONCAT(Artist.name).python_value(str_to_list)
+    artist_ids = group_concat(Artist.id).python_value(str_to_list)
+    artist_names = group_concat(Artist.name).python_value(str_to_list)
 
     return (
         user.played.select(
@@ -556,16 +1293,10 @@ def get_track_artists(track_query):
             )
 
 
-def get_recent(user, page=1, page_size=10):
-    query = (
-        get_recent_query(user)
-        .order_by(Play.date.desc(), Play.track)
-        .paginate(page, page_size)
-    )
-    print(query)
+def fill_recent_feed(user):
+    """Fill the recent feed with the plays we stored before having it"""
 
-    def get_picture(recent):
-        album_picture = recent.track.album.picture
+    def get_picture(album_picture):
         if not album_picture:
             return
         try:
@@ -574,31 +1305,57 @@ def get_recent(user, page=1, page_size=10):
         except ValueError:
             return album_picture
 
-    results = []
+    rows = (
+        dict(
+            user=user.id,
+            date=recent.date,
+            track=recent.track.id,
+            title=recent.track.title,
+            album_id=recent.track.album.id if recent.track.album else None,
+            album_name=recent.track.album.name if recent.track.album else None,
+            picture=(
+                get_picture(recent.track.album.picture) if recent.track.album else None
+            ),
+            artists=[
+                dict(id=artist_id, name=artist_name)
+                for artist_id, artist_name in dict(
+                    zip(recent.artist_ids, recent.artist_names)
+                ).items()
+            ],
+        )
+        for recent in get_recent_query(user)
+    )
+    with write_batch():
+        inserted, _ = RecentPlay.bulk_upsert(rows)
+        SyncState.set_state(user, "recent_feed_filled")
+    logger.debug(f"Filled the recent feed of {user} with {inserted} plays")
+
 
-    for recent in query:
-        recent_id = f'{recent.track.id}-{recent.date.strftime("%Y-%m-%d %H:%M")}'
-        artists = {
-            artist_id: artist_name
-            for artist_id, artist_name in zip(recent.artist_ids, recent.artist_names)
-        }
-        results.append(
-            dict(
-                id=recent_id,
-                track=dict(
-                    id=recent.track.id,
-                    title=recent.track.title,
-                    album=dict(
-                        id=recent.track.album.id,
-                        name=recent.track.album.name,
-                        picture=get_picture(recent),
-                    ),
-                    artists=[
-                        dict(id=artist_id, name=artist_name)
-                        for artist_id, artist_name in artists.items()
-                    ],
+def get_recent(user, page_size=10, cursor=None):
+    """A page of the recent plays of a user
+    Returns the plays and the cursor of the next page
+    """
+    recents, next_cursor = paginate_keyset(
+        RecentPlay.select().where(RecentPlay.user == user),
+        RecentPlay.date,
+        RecentPlay.track,
+        page_size,
+        cursor,
+    )
+    return [
+        dict(
+            id=f'{recent.track_id}-{recent.date.strftime("%Y-%m-%d %H:%M")}',
+            track=dict(
+                id=recent.track_id,
+                title=recent.title,
+                album=dict(
+                    id=recent.album_id,
+                    name=recent.album_name,
+                    picture=recent.picture,
                 ),
-                date=recent.date,
-            )
+                artists=recent.artists,
+            ),
+            date=recent.date,
         )
-    return results
+        for recent in recents
+    ], next_cursor
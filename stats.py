@@ -0,0 +1,103 @@
+"""The listening stats of a user: play counts per track, artist or album
+over rolling windows, aggregated in SQL from the stored plays
+"""
+
+import datetime
+
+import peewee
+
+from store import Album, Artist, Play, Track, TrackArtist
+
+STATS_BY = ("track", "artist", "album")
+DEFAULT_WINDOWS = (7, 30, 365)  # days
+MAX_WINDOW_DAYS = 36500  # more than any history, far from the datetime range
+
+
+def track_play_counts(user, windows, now):
+    """The plays per track in every window, with a conditional sum per window:
+    a single range scan of the (user, date, track) index, over the largest window
+    """
+    columns = [
+        peewee.fn.SUM(
+            peewee.Case(
+                None, [(Play.date >= now - datetime.timedelta(days=days), 1)], 0
+            )
+        ).alias(f"plays_{index}")
+        for index, days in enumerate(windows)
+    ]
+    return (
+        Play.select(
+            Play.track.alias("track_id"),
+            *columns,
+            peewee.fn.MAX(Play.date).alias("last_played"),
+        )
+        .where(
+            Play.user == user,
+            Play.date >= now - datetime.timedelta(days=max(windows)),
+        )
+        .group_by(Play.track)
+    )
+
+
+def play_stats(
+    user, by="track", windows=DEFAULT_WINDOWS, limit=20, min_plays=1, now=None
+):
+    """The most played tracks, artists or albums of a user
+    counting the plays in the rolling windows of `windows` days.
+    The plays are counted per track first, then summed per artist or album:
+    the joins run on the tracks played, not on every play.
+    The rows are sorted by the plays in the first window, and have at least `min_plays`
+    Returns [{"id", "name", "plays": {days: count}, "last_played"}]
+    """
+    if by not in STATS_BY:
+        raise ValueError(f"Unknown stats: {by}")
+    if not windows or any(not 0 < days <= MAX_WINDOW_DAYS for days in windows):
+        raise ValueError(f"Invalid windows: {windows}")
+    if limit is not None and limit < 1:
+        raise ValueError(f"Invalid limit: {limit}")
+    now = now or datetime.datetime.utcnow()
+    counts = track_play_counts(user, windows, now).alias("counts")
+
+    if by == "track":
+        key, name = Track.id, Track.title
+        query = Track.select().join(counts, on=(Track.id == counts.c.track_id))
+    elif by == "artist":
+        key, name = Artist.id, Artist.name
+        query = (
+            Artist.select()
+            .join(TrackArtist)
+            .join(counts, on=(TrackArtist.track == counts.c.track_id))
+        )
+    else:
+        key, name = Album.id, Album.name
+        query = (
+            Album.select().join(Track).join(counts, on=(Track.id == counts.c.track_id))
+        )
+
+    plays = [
+        peewee.fn.SUM(getattr(counts.c, f"plays_{index}"))
+        for index in range(len(windows))
+    ]
+    query = (
+        query.select(
+            key,
+            name,
+            *(count.alias(f"plays_{index}") for index, count in enumerate(plays)),
+            peewee.fn.MAX(counts.c.last_played).alias("last_played"),
+        )
+        .group_by(key, name)
+        .having(plays[0] >= min_plays)
+        .order_by(plays[0].desc(), key)
+        .tuples()
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    return [
+        dict(
+            id=row[0],
+            name=row[1],
+            plays=dict(zip(windows, row[2:-1])),
+            last_played=Play.date.python_value(row[-1]),
+        )
+        for row in query
+    ]
@@ -1,48 +1,332 @@
 import atexit
+import base64
+import contextlib
 import datetime
+import functools
+import json
+import logging
+import operator
+import threading
 
 import peewee
-from playhouse.sqlite_ext import JSONField
+from cachetools import LRUCache, TTLCache
+from playhouse.migrate import SchemaMigrator
+from playhouse.pool import PooledPostgresqlDatabase, PooledSqliteDatabase
+
+from metrics import metrics
+
+logger = logging.getLogger("spotlike.store")
+
+DATABASE_DEFAULTS = {
+    "engine": "sqlite",  # or "postgres"
+    "path": "spotlike.db",
+    # for postgres
+    "name": "spotlike",
+    "host": None,
+    "port": None,
+    "user": None,
+    "password": None,
+    # a pool keeps the connections open between the requests
+    "pool": False,
+    "max_connections": 8,
+    "stale_timeout": 300,
+    "pragmas": {
+        # readers don't wait for the writer, and the writer doesn't wait for them
+        "journal_mode": "wal",
+        # safe with WAL - we may lose the last commit on a crash
+        "synchronous": "normal",
+        "cache_size": -32 * 1024,  # in KiB when negative: 32MB of page cache
+        "mmap_size": 128 * 1024 * 1024,
+        # ms to wait for a lock, rather than failing with "database is locked"
+        "busy_timeout": 10_000,
+    },
+}
+
+# the catalog rows (tracks, albums, artists and their links) we remember writing
+CATALOG_CACHE_SIZE = 100_000
+
+db = peewee.DatabaseProxy()
+_write_lock = threading.RLock()
+
+
+def get_database(db_config=None):
+    """A database from the "DATABASE" settings of the config,
+    with the defaults for the rest
+    """
+    settings = {**DATABASE_DEFAULTS, **(db_config or {})}
+    if settings["engine"] == "postgres":
+        connect_params = {
+            key: settings[key]
+            for key in ("host", "port", "user", "password")
+            if settings[key] is not None
+        }
+        if settings["pool"]:
+            return PooledPostgresqlDatabase(
+                settings["name"],
+                max_connections=settings["max_connections"],
+                stale_timeout=settings["stale_timeout"],
+                **connect_params,
+            )
+        return peewee.PostgresqlDatabase(settings["name"], **connect_params)
+    if settings["engine"] != "sqlite":
+        raise ValueError(f"Unknown database engine: {settings['engine']}")
+
+    pragmas = {**DATABASE_DEFAULTS["pragmas"], **settings["pragmas"]}
+    if settings["pool"]:
+        return PooledSqliteDatabase(
+            settings["path"],
+            pragmas=pragmas,
+            max_connections=settings["max_connections"],
+            stale_timeout=settings["stale_timeout"],
+        )
+    return peewee.SqliteDatabase(settings["path"], pragmas=pragmas)
+
+
+def instrument_queries(database):
+    """Time the queries of the database, per model"""
+    execute = database.execute
+
+    def timed_execute(query, *args, **kwargs):
+        model = getattr(query, "model", None)
+        with metrics.timer(
+            "db_query_seconds", model=model.__name__ if model else "raw"
+        ):
+            return execute(query, *args, **kwargs)
+
+    database.execute = timed_execute
+    return database
+
+
+def configure_db(db_config=None):
+    """Point the models to the database from the config"""
+    if db.obj is not None and not db.is_closed():
+        db.close()
+    db.initialize(instrument_queries(get_database(db_config)))
+    return db.obj
 
-db = peewee.SqliteDatabase("spotlike.db")
+
+configure_db()
+
+
+def is_sqlite():
+    return isinstance(db.obj, peewee.SqliteDatabase)
+
+
+@contextlib.contextmanager
+def write_batch():
+    """A transaction holding the process-wide writer lock:
+    SQLite has a single writer, so concurrent jobs serialize their write batches
+    """
+    lock = _write_lock if is_sqlite() else contextlib.nullcontext()
+    with lock:
+        try:
+            with db.atomic():
+                yield
+        except BaseException:
+            catalog_cache.discard()
+            raise
+        if not db.in_transaction():
+            catalog_cache.commit()  # the catalog rows written are in the DB now
+
+
+def distinct_from(lhs, rhs):
+    """A NULL-safe inequality - so a NULL -> value change counts as a change"""
+    return peewee.Expression(lhs, "IS NOT" if is_sqlite() else "IS DISTINCT FROM", rhs)
+
+
+def group_concat(field):
+    """The comma-separated values of a group"""
+    if is_sqlite():
+        return peewee.fn.GROUP_CONCAT(field)
+    return peewee.fn.STRING_AGG(field, ",")
+
+
+class JSONField(peewee.TextField):
+    """A JSON value, serialized in a text column on every backend"""
+
+    def db_value(self, value):
+        if value is not None:
+            return json.dumps(value)
+
+    def python_value(self, value):
+        if value is not None:
+            return json.loads(value)
 
 
 class BaseModel(peewee.Model):
     class Meta:
         database = db
 
-    def get_by_any_id(self, **kwargs):
-        Model = self._meta.model
-        if isinstance(self._pk, tuple):
-            key = {k.name: kwargs[k.name] for k in self._meta.get_primary_keys()}
-            return Model.get(**key)
-        else:
-            return Model.get_by_id(self._pk)
+    @classmethod
+    def natural_key(cls):
+        """The fields identifying a row: the primary key
+        or the first unique index, for the tables with an autoincrement id
+        """
+        if isinstance(cls._meta.primary_key, peewee.AutoField):
+            for fields, unique in cls._meta.indexes:
+                if unique:
+                    return [cls._meta.fields[name] for name in fields]
+        return cls._meta.get_primary_keys()
+
+    @classmethod
+    def bulk_upsert(cls, rows, batch_size=100):
+        """Insert or update many rows (dicts keyed by field name)
+        with a multi-row INSERT ... ON CONFLICT DO UPDATE per batch.
+        Existing rows are updated only when some value differs.
+        Returns a tuple (inserted, changed) with the number of rows touched
+        """
+        pk_fields = cls.natural_key()
+        # dedupe on the key - the last version wins
+        unique_rows = {tuple(row[f.name] for f in pk_fields): row for row in rows}
+        if not unique_rows:
+            return 0, 0
+        passed_fields = next(iter(unique_rows.values())).keys()
+        pk_names = {f.name for f in pk_fields}
+        update_fields = [
+            f
+            for f in cls._meta.sorted_fields
+            if f.name in passed_fields and f.name not in pk_names
+        ]
+
+        inserted = changed = 0
+        for keys, batch in zip(
+            peewee.chunked(unique_rows.keys(), batch_size),
+            peewee.chunked(unique_rows.values(), batch_size),
+        ):
+            query = cls.insert_many(batch)
+            if not update_fields:
+                # a relation table - there's nothing to update
+                inserted += cls._meta.database.execute(
+                    query.on_conflict_ignore()
+                ).rowcount
+                continue
+
+            existing = cls.select().where(peewee.Tuple(*pk_fields).in_(keys)).count()
+            query = query.on_conflict(
+                conflict_target=pk_fields,
+                preserve=update_fields,
+                where=functools.reduce(
+                    operator.or_,
+                    (
+                        distinct_from(f, getattr(peewee.EXCLUDED, f.column_name))
+                        for f in update_fields
+                    ),
+                ),
+            )
+            touched = cls._meta.database.execute(query).rowcount
+            inserted += len(batch) - existing
+            changed += touched - (len(batch) - existing)
+        return inserted, changed
+
+    @classmethod
+    def upsert(cls, row, update=None):
+        """Insert a row (a dict keyed by field name) or update the existing one
+        - the `update` fields (all but the key by default) and only when some differ.
+        The row has to be insertable: with all the required fields.
+        On Postgres it's a single INSERT ... ON CONFLICT DO UPDATE ... WHERE,
+        telling a new row from the xmax of the one returned.
+        On SQLite the upsert can't tell an insert from an update: we insert
+        ignoring the key conflict, and update the existing row only if it differs.
+        Returns a tuple (inserted, changed)
+        """
+        key_fields = cls.natural_key()
+        key_names = {f.name for f in key_fields}
+        fields = cls._meta.fields
+        update_fields = [
+            fields[name]
+            for name in (row if update is None else update)
+            if name not in key_names
+        ]
+        database = cls._meta.database
+        if not update_fields:
+            query = cls.insert(row).on_conflict(
+                conflict_target=key_fields, action="NOTHING"
+            )
+            return database.execute(query).rowcount == 1, False
+
+        if not is_sqlite():
+            query = (
+                cls.insert(row)
+                .on_conflict(
+                    conflict_target=key_fields,
+                    preserve=update_fields,
+                    where=functools.reduce(
+                        operator.or_,
+                        (
+                            distinct_from(f, getattr(peewee.EXCLUDED, f.column_name))
+                            for f in update_fields
+                        ),
+                    ),
+                )
+                .returning(peewee.SQL("(xmax = 0)"))
+            )
+            touched = database.execute(query).fetchone()
+            if touched is None:  # the row exists, unchanged
+                return False, False
+            return bool(touched[0]), not touched[0]
+
+        query = cls.insert(row).on_conflict(
+            conflict_target=key_fields, action="NOTHING"
+        )
+        if database.execute(query).rowcount == 1:
+            return True, False
+        query = cls.update({f: row[f.name] for f in update_fields}).where(
+            *(f == row[f.name] for f in key_fields),
+            functools.reduce(
+                operator.or_, (distinct_from(f, row[f.name]) for f in update_fields)
+            ),
+        )
+        return False, query.execute() == 1
 
     def insert_or_update(self, **kwargs):
+        """Set the fields and upsert the row: the passed fields are updated
+        when the row exists, the defaults are only for a new one.
+        `_new` tells if it was inserted
+        """
         for field, value in kwargs.items():
             setattr(self, field, value)
-        passed_fields = {field for field in kwargs}
-
-        if self.dirty_fields:
-            Model = self._meta.model
-            try:
-                existing = self.get_by_any_id(**kwargs)
-                changed_fields = []
-                for field in self.dirty_fields:
-                    if (
-                        getattr(existing, field.name) != getattr(self, field.name)
-                        and field.name in passed_fields
-                    ):
-                        changed_fields.append(field)
-                if changed_fields:
-                    self.save(only=changed_fields)  # change only the changed fields
-            except Model.DoesNotExist:
-                self.save(force_insert=True)
-                self._new = True
+        self._new, _ = self.upsert(dict(self.__data__), update=kwargs.keys())
+        self._dirty.clear()
         return self
 
 
+def encode_cursor(date, key):
+    """An opaque pagination cursor, pointing after the (date, key) row"""
+    payload = json.dumps([date.isoformat(), key]).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        date, key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(date), key
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def paginate_keyset(query, date_field, key_field, page_size, cursor=None):
+    """A page of the query, newest first, with keyset pagination on (date, key):
+    no OFFSET, and rows inserted meanwhile don't shift the pages
+    Returns the rows and the cursor of the next page (None on the last page)
+    """
+    if page_size < 1:
+        raise ValueError(f"Invalid page size: {page_size}")
+    query = query.order_by(date_field.desc(), key_field.desc())
+    if cursor:
+        date, key = decode_cursor(cursor)
+        query = query.where(
+            peewee.Tuple(date_field, key_field) < peewee.Tuple(date, key)
+        )
+    rows = list(query.limit(page_size + 1))
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    last = rows[-1]
+    # for the foreign keys we want the id, not the related object
+    key_name = getattr(key_field, "object_id_name", key_field.name)
+    return rows, encode_cursor(getattr(last, date_field.name), getattr(last, key_name))
+
+
 class User(BaseModel):
     id = peewee.CharField(primary_key=True)
     name = peewee.CharField()
@@ -68,10 +352,61 @@ class User(BaseModel):
         except Friendship.DoesNotExist:
             return False
 
+    def save(self, *args, **kwargs):
+        user_cache.invalidate(self.id)  # a new token or a new profile
+        return super().save(*args, **kwargs)
+
+    @classmethod
+    def upsert(cls, row, update=None):
+        user_cache.invalidate(row["id"])
+        return super().upsert(row, update)
+
     def __str__(self):
         return f"{self.email}"
 
 
+class UserCache:
+    """A process-level TTL cache of the users, without their tokens
+    disabled until it's configured with a ttl
+    """
+
+    fields = ("id", "name", "email", "picture", "join_date", "is_admin")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cache = None
+
+    def configure(self, ttl, maxsize=1024):
+        with self.lock:
+            self.cache = TTLCache(maxsize=maxsize, ttl=ttl) if ttl else None
+
+    def get(self, uid):
+        """The user (without the tokens) or None if it doesn't exist"""
+        with self.lock:
+            user = self.cache.get(uid) if self.cache is not None else None
+        if user is None:
+            try:
+                user = (
+                    User.select(*(getattr(User, field) for field in self.fields))
+                    .where(User.id == uid)
+                    .get()
+                )
+            except User.DoesNotExist:
+                return None
+            with self.lock:
+                if self.cache is not None:
+                    self.cache[uid] = user
+        return user
+
+    def invalidate(self, uid):
+        with self.lock:
+            if self.cache is not None:
+                self.cache.pop(uid, None)
+
+
+user_cache = UserCache()
+
+
 class Artist(BaseModel):
     id = peewee.CharField(primary_key=True)
     name = peewee.CharField()
@@ -92,6 +427,9 @@ class Track(BaseModel):
     duration = peewee.IntegerField()
     album = peewee.ForeignKeyField(Album, null=True)
 
+    class Meta:
+        indexes = ((("title", "duration"), False),)  # to find the duplicates
+
 
 class TrackArtist(BaseModel):
     # a many-to-many relation table
@@ -111,23 +449,218 @@ class AlbumArtist(BaseModel):
         primary_key = peewee.CompositeKey("album", "artist")
 
 
+class CatalogCache:
+    """A process-wide LRU of the catalog rows written: (model, key) -> content hash
+    shared by all the users, so the tracks in more libraries are written once.
+    The rows are hashed on the fields we store, and the known ones are skipped.
+    The new hashes wait for the outermost write batch to commit: after a rollback
+    the cache doesn't claim rows the DB hasn't got.
+    It belongs to a database - pointing the models elsewhere empties it
+    """
+
+    def __init__(self, maxsize=CATALOG_CACHE_SIZE):
+        self.lock = threading.Lock()
+        self.local = threading.local()  # the pending hashes of the thread
+        self.configure(maxsize)
+
+    def configure(self, maxsize):
+        with self.lock:
+            self.cache = LRUCache(maxsize=maxsize) if maxsize else None
+            self.database = db.obj
+            self.hits = self.misses = 0
+
+    @staticmethod
+    def key(Model, row):
+        return Model, tuple(row[field.name] for field in Model.natural_key())
+
+    @staticmethod
+    def content_hash(Model, row):
+        fields = Model._meta.fields
+        return hash(
+            tuple((name, fields[name].db_value(row[name])) for name in sorted(row))
+        )
+
+    def _check_database(self):
+        if self.database is not db.obj:
+            self.cache.clear()
+            self.database = db.obj
+
+    def changed(self, Model, rows):
+        """The rows not written yet, or changed since they were"""
+        if self.cache is None:
+            return list(rows)
+        hashes = [
+            (row, self.key(Model, row), self.content_hash(Model, row)) for row in rows
+        ]
+        with self.lock:
+            self._check_database()
+            changed = [item for item in hashes if self.cache.get(item[1]) != item[2]]
+            self.hits += len(hashes) - len(changed)
+            self.misses += len(changed)
+        pending = self.pending()
+        pending.update((key, content_hash) for _, key, content_hash in changed)
+        return [row for row, _, _ in changed]
+
+    def pending(self):
+        if not hasattr(self.local, "pending"):
+            self.local.pending = {}
+        return self.local.pending
+
+    def commit(self):
+        pending = self.pending()
+        if pending and self.cache is not None:
+            with self.lock:
+                self._check_database()
+                self.cache.update(pending)
+        pending.clear()
+
+    def discard(self):
+        self.pending().clear()
+
+    def prewarm(self, models_fields):
+        """Load the hashes of the rows in the DB: {Model: field names}
+        up to the cache size
+        """
+        if self.cache is None:
+            return 0
+        loaded = 0
+        for Model, names in models_fields.items():
+            room = self.cache.maxsize - loaded
+            if room <= 0:
+                break
+            fields = [Model._meta.fields[name] for name in names]
+            rows = [
+                dict(zip(names, values))
+                for values in Model.select(*fields).limit(room).tuples()
+            ]
+            with self.lock:
+                self._check_database()
+                for row in rows:
+                    self.cache[self.key(Model, row)] = self.content_hash(Model, row)
+            loaded += len(rows)
+        return loaded
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return dict(
+                size=len(self.cache) if self.cache is not None else 0,
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=self.hits / lookups if lookups else None,
+            )
+
+
+catalog_cache = CatalogCache()
+
+
 class Play(BaseModel):
-    user = peewee.ForeignKeyField(User, backref="played")
-    track = peewee.ForeignKeyField(Track)
+    # a compact history: an integer rowid, the date in epoch milliseconds
+    # and the (user, date, track) unique index covering the queries by user and date
+    user = peewee.ForeignKeyField(User, backref="played", index=False)
+    track = peewee.ForeignKeyField(Track, index=False)
+    date = peewee.TimestampField(resolution=1000, utc=True)
+
+    class Meta:
+        indexes = (
+            (("user", "date", "track"), True),
+            # the play counts per track scan it in order, without sorting
+            (("user", "track", "date"), False),
+        )
+
+
+class RecentPlay(BaseModel):
+    """The feed of the recent plays, denormalized as the API shows them:
+    a page is a range scan on the primary key
+    """
+
+    user = peewee.ForeignKeyField(User, backref="recent_plays")
     date = peewee.DateTimeField()
+    track = peewee.ForeignKeyField(Track)
+    title = peewee.CharField()
+    album_id = peewee.CharField(null=True)
+    album_name = peewee.CharField(null=True)
+    picture = peewee.CharField(null=True)
+    artists = JSONField()  # [{"id": ..., "name": ...}]
 
     class Meta:
-        primary_key = peewee.CompositeKey("user", "track", "date")
+        primary_key = peewee.CompositeKey("user", "date", "track")
 
 
 class Liked(BaseModel):
-    # a many-to-many relation table
-    user = peewee.ForeignKeyField(User, backref="liked")
-    track = peewee.ForeignKeyField(Track)
-    date = peewee.DateTimeField()
+    # a many-to-many relation table - compact as the Play one, with the epoch seconds
+    user = peewee.ForeignKeyField(User, backref="liked", index=False)
+    track = peewee.ForeignKeyField(Track, index=False)
+    date = peewee.TimestampField(utc=True)
 
     class Meta:
-        primary_key = peewee.CompositeKey("user", "track", "date")
+        indexes = (
+            (("user", "date", "track"), True),
+            (("user", "track", "date"), False),
+        )
+
+
+class SyncState(BaseModel):
+    """Per-user bookkeeping of the incremental jobs (last full syncs, watermarks...)"""
+
+    user = peewee.ForeignKeyField(User, backref="sync_states")
+    name = peewee.CharField()
+    value = JSONField(null=True)
+    date = peewee.DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        primary_key = peewee.CompositeKey("user", "name")
+
+    @classmethod
+    def get_state(cls, user, name):
+        try:
+            return cls.get(cls.user == user, cls.name == name)
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def set_state(cls, user, name, value=None):
+        cls.bulk_upsert(
+            [
+                dict(
+                    user=user.id,
+                    name=name,
+                    value=value,
+                    date=datetime.datetime.utcnow(),
+                )
+            ]
+        )
+
+
+class Outbox(BaseModel):
+    """The Spotify changes we still have to send - so an interrupted run resumes them.
+    One row per user, playlist and track: the last action wins
+    """
+
+    user = peewee.ForeignKeyField(User, backref="outbox", index=False)
+    playlist = peewee.CharField(default="")  # "" for the saved tracks
+    track = peewee.CharField()
+    action = peewee.CharField()  # like, unlike (the saved tracks), add, remove
+    attempts = peewee.IntegerField(default=0)
+    date = peewee.DateTimeField(default=datetime.datetime.utcnow)
+
+    class Meta:
+        indexes = ((("user", "playlist", "track"), True),)
+
+    @classmethod
+    def enqueue(cls, user, action, tracks, playlist=""):
+        now = datetime.datetime.utcnow()
+        cls.bulk_upsert(
+            dict(
+                user=user.id,
+                playlist=playlist,
+                track=track,
+                action=action,
+                attempts=0,
+                date=now,
+            )
+            for track in tracks
+        )
 
 
 class Message(BaseModel):
@@ -136,6 +669,9 @@ class Message(BaseModel):
     date = peewee.DateTimeField(default=datetime.datetime.utcnow)
     msg_type = peewee.CharField(null=True)
 
+    class Meta:
+        indexes = ((("user", "date"), False),)
+
 
 class Friendship(BaseModel):
     """The friendship model is like:
@@ -151,26 +687,119 @@ class Friendship(BaseModel):
     pending = peewee.BooleanField(default=True)
 
 
+class SchemaVersion(BaseModel):
+    """The migrations applied to the database"""
+
+    version = peewee.IntegerField(primary_key=True)
+    name = peewee.CharField()
+    date = peewee.DateTimeField(default=datetime.datetime.utcnow)
+
+
+MODELS = (
+    User,
+    Track,
+    Artist,
+    TrackArtist,
+    Album,
+    AlbumArtist,
+    Play,
+    RecentPlay,
+    Liked,
+    SyncState,
+    Outbox,
+    Message,
+    Friendship,
+    SchemaVersion,
+)
+
+# the schema changes: [(version, migration)], sorted by version
+MIGRATIONS = []
+
+
+def migration(version):
+    """Register a schema change, to be applied once on the existing databases.
+    The migration is called with a playhouse SchemaMigrator - new tables and indexes
+    don't need one: `initdb` creates them
+    """
+
+    def decorator(func):
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=operator.itemgetter(0))
+        return func
+
+    return decorator
+
+
+def migrate_db():
+    """Apply the pending migrations - in order, each in its own transaction"""
+    applied = {row.version for row in SchemaVersion.select(SchemaVersion.version)}
+    migrator = SchemaMigrator.from_database(db.obj)
+    for version, func in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Migrating the database to version {version}: {func.__name__}")
+        with db.atomic():
+            func(migrator)
+            SchemaVersion.create(version=version, name=func.__name__)
+
+
+@migration(1)
+def compact_history(migrator):
+    """Play and Liked had a (user, track, date) primary key and datetime strings:
+    copy them to the compact tables with a rowid and the epoch dates
+    """
+    for model in (Play, Liked):
+        table = model._meta.table_name
+        if not model.table_exists():
+            continue
+        resolution = model.date.resolution
+        if is_sqlite():
+            seconds = "(julianday(date) - 2440587.5) * 86400"
+            epoch = f"CAST(ROUND({seconds} * {resolution}) AS INTEGER)"
+        else:
+            epoch = f"CAST(EXTRACT(EPOCH FROM date) * {resolution} AS BIGINT)"
+        db.execute_sql(f'CREATE TABLE "{table}_old" AS SELECT * FROM "{table}"')
+        db.execute_sql(f'DROP TABLE "{table}"')
+        model.create_table()
+        db.execute_sql(
+            f'INSERT INTO "{table}" ("user_id", "track_id", "date")'
+            f' SELECT "user_id", "track_id", {epoch} FROM "{table}_old"'
+            f' ORDER BY "user_id", "date"'
+        )
+        db.execute_sql(f'DROP TABLE "{table}_old"')
+
+
+@migration(2)
+def play_track_date_index(migrator):
+    """The (user, track) index of the plays gives way to the (user, track, date) one"""
+    db.execute_sql('DROP INDEX IF EXISTS "play_user_id_track_id"')
+
+
+@migration(3)
+def liked_track_date_index(migrator):
+    """The (user, track) index of the likes is replaced by the (user, track, date) one:
+    the duplicates lookup finds the like date of a track in the index
+    """
+    db.execute_sql('DROP INDEX IF EXISTS "liked_user_id_track_id"')
+
+
 def closedb():
     db.close()
 
 
 def initdb():
     db.connect(reuse_if_open=True)
-    db.create_tables(
-        (
-            User,
-            Track,
-            Artist,
-            TrackArtist,
-            Album,
-            AlbumArtist,
-            Play,
-            Liked,
-            Message,
-            Friendship,
-        )
-    )
+    new_database = not User.table_exists()
+    SchemaVersion.create_table()
+    if new_database:
+        # the tables are created with the latest schema
+        SchemaVersion.insert_many(
+            [dict(version=version, name=func.__name__) for version, func in MIGRATIONS]
+        ).execute()
+    else:
+        # before creating the new indexes: they may need the migrated columns
+        migrate_db()
+    db.create_tables(MODELS)
     atexit.register(closedb)
 
 
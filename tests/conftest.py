@@ -0,0 +1,98 @@
+import pytest
+
+import spotclient
+import store
+from spottools import SpotUserActions
+from tests.fakes import page, saved
+
+
+class FakeSpotify:
+    """The Spotify endpoints of the user actions, over an in-memory library:
+    the saved tracks, a playlist and the top tracks
+    """
+
+    def __init__(self, likes=()):
+        self.likes = list(likes)
+        self.added_likes = []
+        self.top_tracks = []
+        self.playlist_tracks = []
+        self.snapshot = 1
+        self.downloads = 0
+
+    def current_user_saved_tracks(self, limit=50):
+        return page(self.likes, limit)
+
+    def current_user_saved_tracks_contains(self, tracks):
+        liked = {liked["track"]["id"] for liked in self.likes}
+        return [track_id in liked for track_id in tracks]
+
+    def current_user_saved_tracks_add(self, tracks):
+        self.added_likes.extend(tracks)
+
+    def current_user_top_tracks(self, time_range):
+        return dict(
+            items=[dict(id=track_id) for track_id in self.top_tracks], next=None
+        )
+
+    def current_user_playlists(self):
+        return page(
+            [
+                dict(
+                    id="pl",
+                    name="Liked",
+                    owner=dict(id="me"),
+                    snapshot_id=self.snapshot,
+                )
+            ]
+        )
+
+    def playlist_items(self, playlist_id, additional_types=()):
+        self.downloads += 1
+        return page(self.playlist_tracks)
+
+    def playlist_add_items(self, playlist_id, tracks, position=None):
+        self.playlist_tracks[:0] = [
+            saved(track_id, "2020-01-01T00:00:00Z") for track_id in tracks
+        ]
+        self.snapshot += 1
+
+    def playlist_remove_all_occurrences_of_items(self, playlist_id, tracks):
+        self.playlist_tracks = [
+            t for t in self.playlist_tracks if t["track"]["id"] not in tracks
+        ]
+        self.snapshot += 1
+
+    def playlist(self, playlist_id, fields=None):
+        return dict(snapshot_id=self.snapshot)
+
+
+@pytest.fixture
+def memory_db():
+    store.configure_db(dict(path=":memory:"))
+    store.db.connect()
+    store.db.create_tables(store.MODELS)
+    yield store.db
+    store.db.close()
+    store.configure_db()
+
+
+@pytest.fixture
+def spotify():
+    """The fake Spotify client - with no likes and an empty playlist"""
+    return FakeSpotify()
+
+
+@pytest.fixture
+def act(memory_db, spotify):
+    """A SpotUserActions of a stored user - on the fake Spotify client"""
+    act = SpotUserActions(auth_manager=object(), connect=False)
+    act.user = store.User.create(id="me", name="Me", email="me@example.com", tokens={})
+    act.spotify = spotify
+    return act
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waited = []
+    monkeypatch.setattr(spotclient.time, "sleep", waited.append)
+    return waited
@@ -0,0 +1,54 @@
+"""The Spotify objects and calls the tests fake"""
+
+import spotipy
+
+from spotclient import RateLimitedSpotify, RequestStats, TokenBucket
+
+
+def spotify_track(track_id, name="A song", album_id="album", artist_id="artist"):
+    artist = dict(id=artist_id, name=f"Artist {artist_id}")
+    return dict(
+        id=track_id,
+        name=name,
+        duration_ms=180000,
+        artists=[artist],
+        album=dict(
+            id=album_id,
+            name=f"Album {album_id}",
+            release_date="1967-08",
+            release_date_precision="month",
+            images=[],
+            artists=[artist],
+        ),
+    )
+
+
+def saved(track_id, added_at, name="A song"):
+    """A saved track (or a playlist item)"""
+    return dict(added_at=added_at, track=spotify_track(track_id, name=name))
+
+
+def page(items, limit=50):
+    return dict(items=items[:limit], next=None, offset=0, limit=limit, total=len(items))
+
+
+def failing_call(*errors):
+    """A fake Spotify call raising the given errors, then succeeding"""
+    errors = list(errors)
+
+    def internal_call(self, method, url, payload, params):
+        if errors:
+            raise errors.pop(0)
+        return {"ok": True}
+
+    return internal_call
+
+
+def get_client(monkeypatch, *errors, max_retries=8):
+    monkeypatch.setattr(spotipy.Spotify, "_internal_call", failing_call(*errors))
+    return RateLimitedSpotify(
+        auth="token",
+        max_retries=max_retries,
+        limiter=TokenBucket(rate=1000),
+        stats=RequestStats(),
+    )
@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import urllib.parse
+
+import pytest
+
+import aiospottools
+import store
+from aiospottools import AsyncSpotify, AsyncSpotUserActions, sync_all_users
+from spotclient import RequestStats, TokenBucket
+from tests.fakes import saved
+
+httpx = pytest.importorskip("httpx")
+
+
+class FakeAuth:
+    def get_access_token(self, as_dict=True):
+        return "token"
+
+
+def fake_api(total=95, limit=10, throttle=0):
+    """A saved-tracks endpoint serving `total` items, throttling the first requests"""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if len(requests) <= throttle:
+            return httpx.Response(429, headers={"Retry-After": "0"}, json={})
+        offset = int(request.url.params.get("offset", 0))
+        end = min(offset + limit, total)
+        query = urllib.parse.urlencode(dict(limit=limit, offset=end))
+        return httpx.Response(
+            200,
+            json=dict(
+                items=list(range(offset, end)),
+                offset=offset,
+                limit=limit,
+                total=total,
+                next=(
+                    f"{request.url.copy_with(query=None)}?{query}"
+                    if end < total
+                    else None
+                ),
+            ),
+        )
+
+    return requests, httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def get_act(client):
+    act = AsyncSpotUserActions.__new__(AsyncSpotUserActions)
+    act.spotify = AsyncSpotify(
+        FakeAuth(), client=client, limiter=TokenBucket(rate=1000), stats=RequestStats()
+    )
+    return act
+
+
+async def collect(act, prefetch):
+    results = await act.spotify.current_user_saved_tracks()
+    return [item async for item in act.get_spotify_list(results, prefetch=prefetch)]
+
+
+@pytest.fixture
+def file_db(tmp_path):
+    # the DB is written from a worker thread: it can't be in memory
+    store.configure_db(dict(path=str(tmp_path / "test.db")))
+    store.db.create_tables(store.MODELS)
+    yield store.db
+    store.db.close()
+    store.configure_db()
+
+
+class TestAsyncSpotify:
+    @pytest.mark.parametrize("prefetch", [False, True])
+    def test_pagination_keeps_the_order(self, prefetch):
+        requests, client = fake_api()
+        items = asyncio.run(collect(get_act(client), prefetch))
+        assert items == list(range(95))
+        assert len(requests) == 10
+
+    def test_throttled_requests_are_retried(self):
+        requests, client = fake_api(throttle=2)
+        act = get_act(client)
+        assert asyncio.run(collect(act, prefetch=False)) == list(range(95))
+        stats = act.spotify.stats.snapshot()
+        assert stats["rate_limited"] == stats["retries"] == 2
+
+    def test_unlike_in_batches_spotify_accepts(self, file_db):
+        batches = []
+
+        def handler(request):
+            batches.append(request.url.params["ids"].split(","))
+            return httpx.Response(200)
+
+        act = get_act(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        act.user = store.User.create(id="me", name="Me", email="me@e.com", tokens={})
+        asyncio.run(act.unlike_tracks([f"t{i}" for i in range(120)]))
+        assert [len(batch) for batch in batches] == [50, 50, 20]
+
+    def test_a_client_per_run(self, monkeypatch):
+        clients = []
+
+        def http_client():
+            client = httpx.AsyncClient(
+                transport=httpx.MockTransport(lambda request: httpx.Response(200))
+            )
+            clients.append(client)
+            return client
+
+        class FakeActions:
+            def __init__(self, user, client):
+                self.client = client
+
+            async def connect(self):
+                await self.client.get("https://api.spotify.com/v1/me")
+
+            async def sync_liked_with_playlist(self, name):
+                pass
+
+            async def collect_recent(self):
+                pass
+
+        monkeypatch.setattr(aiospottools, "http_client", http_client)
+        monkeypatch.setattr(aiospottools, "AsyncSpotUserActions", FakeActions)
+        for _ in range(2):  # every run has its own event loop
+            assert asyncio.run(sync_all_users(["me"])) == {"ok": 1}
+        assert len(clients) == 2
+        assert all(client.is_closed for client in clients)
+
+    def test_incremental_likes(self, file_db):
+        likes = [saved("b", "2020-02-01T00:00:00Z"), saved("a", "2020-01-01T00:00:00Z")]
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            limit = int(request.url.params["limit"])
+            return httpx.Response(
+                200, json=dict(items=likes[:limit], next=None, total=len(likes))
+            )
+
+        act = get_act(httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        act.user = store.User.create(id="me", name="Me", email="me@e.com", tokens={})
+        act.likes_reconcile_period = datetime.timedelta(days=1)
+        assert asyncio.run(act.collect_likes(page_size=1))  # the first one is full
+        likes.insert(0, saved("c", "2020-03-01T00:00:00Z"))
+        assert not asyncio.run(act.collect_likes(page_size=1))
+        assert [like.track.id for like in store.Liked.select()] == ["b", "a", "c"]
+        assert store.SyncState.get_state(act.user, "likes_watermark").value == (
+            "2020-03-01T00:00:00"
+        )
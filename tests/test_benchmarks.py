@@ -0,0 +1,36 @@
+import pytest
+
+import spotclient
+from benchmarks import run
+
+
+@pytest.fixture
+def unlimited_rate():
+    spotclient.rate_limiter.configure(1000)
+    yield
+    spotclient.rate_limiter.configure(10)
+
+
+class TestBenchmarks:
+    def test_run_size(self, unlimited_rate, tmp_path):
+        results = run.run_size(120, throttle_every=5, workdir=tmp_path)
+
+        by_step = {r["step"]: r for r in results}
+        assert list(by_step) == [
+            "collect_likes",
+            "collect_likes_incremental",
+            "sync_playlist",
+            "sync_playlist_unchanged",
+            "remove_duplicates",
+            "collect_recent",
+        ]
+        assert all(r["size"] == 120 for r in results)
+        # 120 likes in pages of 50, and the retried 429s
+        assert by_step["collect_likes"]["requests"] >= 3
+        assert sum(r["rate_limited"] for r in results) > 0
+        # nothing to send when the playlist is already in sync
+        assert (
+            by_step["sync_playlist_unchanged"]["requests"]
+            < by_step["sync_playlist"]["requests"]
+        )
+        assert all(r["queries"] > 0 for r in results)
@@ -0,0 +1,85 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from webservice import cronned_jobs
+
+
+class FakeActions:
+    """The user jobs, tracking how many users run at once"""
+
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    def __init__(self, user):
+        self.user = user
+
+    def drain_outbox(self, playlist=None):
+        cls = type(self)
+        with cls.lock:
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+        time.sleep(0.02)  # long enough for the other workers to start
+        with cls.lock:
+            cls.running -= 1
+
+    def remove_liked_duplicates(self):
+        pass
+
+    def sync_liked_with_playlist(self, name):
+        if self.user == "broken":
+            raise RuntimeError("boom")
+
+    def collect_recent(self):
+        pass
+
+    def collect_likes(self):
+        pass
+
+
+@pytest.fixture
+def cron(monkeypatch):
+    users = ["u1", "broken", "u2", "u3", "u4"]
+    FakeActions.running = FakeActions.max_running = 0
+    monkeypatch.setattr(cronned_jobs, "SpotUserActions", FakeActions)
+    monkeypatch.setattr(cronned_jobs, "get_config", lambda environment: {})
+    monkeypatch.setattr(cronned_jobs, "activate_config", lambda config: None)
+    monkeypatch.setattr(cronned_jobs, "initdb", lambda: None)
+    monkeypatch.setattr(cronned_jobs, "prewarm_catalog_cache", lambda: 0)
+    monkeypatch.setattr(
+        cronned_jobs, "User", SimpleNamespace(select=lambda: list(users))
+    )
+    monkeypatch.setattr(cronned_jobs, "db", SimpleNamespace(close=lambda: None))
+    return users
+
+
+class TestRunAllJobs:
+    def test_a_failure_does_not_stop_the_others(self, cron):
+        all_stats = cronned_jobs.run_all_jobs(concurrency=2)
+        assert [stats["user"] for stats in all_stats] == cron
+        failed = [stats for stats in all_stats if stats["error"]]
+        assert [stats["user"] for stats in failed] == ["broken"]
+        assert failed[0]["error"] == "sync_playlist: RuntimeError('boom')"
+        assert list(failed[0]["phases"]) == ["drain_outbox", "remove_duplicates"]
+        # the others went through all the phases
+        assert all(
+            len(stats["phases"]) == 5 for stats in all_stats if not stats["error"]
+        )
+
+    def test_concurrency(self, cron):
+        cronned_jobs.run_all_jobs(concurrency=2)
+        assert FakeActions.max_running == 2
+
+        FakeActions.max_running = 0
+        cronned_jobs.run_all_jobs(concurrency=1)
+        assert FakeActions.max_running == 1
+
+    def test_run_stats(self, cron, caplog):
+        caplog.set_level("INFO", logger="spotlike.cron")
+        cronned_jobs.run_all_jobs(concurrency=4)
+        assert "Processed 5 users" in caplog.text
+        assert "- 1 failed" in caplog.text
+        assert "broken: " in caplog.text and "FAILED sync_playlist" in caplog.text
@@ -1,6 +1,9 @@
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from spottools import parse_date
+import pytest
+
+from spottools import DateParser, parse_date
 
 
 class TestDateParsing:
@@ -8,3 +11,58 @@ class TestDateParsing:
         d = "1967-08"
         e = datetime.datetime(1967, 8, 1)
         assert parse_date(d) == e
+
+    @pytest.mark.parametrize(
+        "date_str, expected",
+        [
+            ("1967", datetime.datetime(1967, 1, 1)),
+            ("2020-01-02", datetime.datetime(2020, 1, 2)),
+            ("2020-01-02 10:30", datetime.datetime(2020, 1, 2, 10, 30)),
+            ("2020-01-02 10:30:05", datetime.datetime(2020, 1, 2, 10, 30, 5)),
+            (
+                "2020-01-02 10:30:05.25",
+                datetime.datetime(2020, 1, 2, 10, 30, 5, 250000),
+            ),
+            ("2020-01-02T10:30:05Z", datetime.datetime(2020, 1, 2, 10, 30, 5)),
+            (
+                "2020-01-02T10:30:05.123Z",
+                datetime.datetime(2020, 1, 2, 10, 30, 5, 123000),
+            ),
+            ("2020-1-2", datetime.datetime(2020, 1, 2)),  # strptime only
+        ],
+    )
+    def test_formats(self, date_str, expected):
+        parsed = parse_date(date_str)
+        assert parsed == expected
+        assert parsed.tzinfo is None
+
+    @pytest.mark.parametrize(
+        "date_str",
+        [
+            "2020-01-02T10:30",
+            "2020-01-02 10:30:05Z",
+            "2020-01-02T10:30:05",
+            "2020-01-02T10:30:05+00:00",
+            "2020-01-02 10:30:05.123+01",
+            "20200102",
+            "2020-02-30",
+        ],
+    )
+    def test_invalid(self, date_str):
+        with pytest.raises(ValueError):
+            parse_date(date_str)
+
+    def test_remembers_the_last_format(self):
+        parser = DateParser()
+        assert parser("2020-1-2 3:04") == datetime.datetime(2020, 1, 2, 3, 4)
+        assert parser.last_format == "%Y-%m-%d %H:%M"
+
+    def test_last_format_per_thread(self):
+        parser = DateParser()
+        parser("2020-1-2 3:04")
+        other_thread = ThreadPoolExecutor(1).submit(lambda: parser.last_format)
+        assert other_thread.result() is None
+
+    def test_datetime_passes_through(self):
+        now = datetime.datetime.utcnow()
+        assert parse_date(now) is now
@@ -0,0 +1,53 @@
+from duplicates import find_duplicates, normalize_title
+
+
+def liked(track_id, name, duration, added_at="2020-01-01T00:00:00Z"):
+    return dict(
+        added_at=added_at, track=dict(id=track_id, name=name, duration_ms=duration)
+    )
+
+
+class TestNormalizeTitle:
+    def test_version_suffixes(self):
+        for title in (
+            "Song",
+            "Song - Remastered 2011",
+            "Song - 2011 Remaster",
+            "Song (Live)",
+            "Song - Radio Edit",
+            "SONG [Remastered]",
+            "Song - Live at Wembley - Remastered",
+        ):
+            assert normalize_title(title) == "song", title
+
+    def test_other_songs_are_kept(self):
+        assert normalize_title("Song (Remix)") != normalize_title("Song")
+        assert normalize_title("Live and Let Die") == "live and let die"
+        assert normalize_title("Édith's Song!") == "ediths song"
+
+    def test_only_a_suffix(self):
+        assert normalize_title("Live") == "live"
+
+
+class TestFindDuplicates:
+    def test_duration_tolerance(self):
+        likes = [
+            liked("c", "Song - Remastered", 181500, "2020-03-01T00:00:00Z"),
+            liked("b", "Other", 180000),
+            liked("a", "Song", 180000, "2020-01-01T00:00:00Z"),
+        ]
+        assert find_duplicates(likes) == {
+            ("Song - Remastered", 181500): [
+                ("c", "2020-03-01T00:00:00Z"),
+                ("a", "2020-01-01T00:00:00Z"),
+            ]
+        }
+
+    def test_too_different_durations(self):
+        likes = [liked("b", "Song", 185000), liked("a", "Song", 180000)]
+        assert find_duplicates(likes) == {}
+
+    def test_neighbour_buckets(self):
+        # 179999 and 180001 fall in different buckets
+        likes = [liked("b", "Song", 179999), liked("a", "Song", 180001)]
+        assert len(find_duplicates(likes)) == 1
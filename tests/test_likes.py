@@ -0,0 +1,146 @@
+import pytest
+
+import store
+from tests.fakes import saved
+
+pytestmark = pytest.mark.usefixtures("memory_db")
+
+
+def with_likes(act, likes):
+    """The likes on Spotify, counting the ones we download"""
+    act.fetched = 0
+    act.spotify.likes = likes
+
+    def liked_songs(prefetch=False):
+        for liked in likes:
+            act.fetched += 1
+            yield liked
+
+    act.liked_songs = liked_songs
+
+
+class TestIncrementalLikes:
+    likes = [
+        saved("c", "2020-03-01T00:00:00Z"),
+        saved("b", "2020-02-01T00:00:00Z"),
+        saved("a", "2020-01-01T00:00:00Z"),
+    ]
+
+    def test_first_run_is_full(self, act):
+        with_likes(act, self.likes)
+        likes = act.cached_likes()
+        assert [liked["track"]["id"] for liked in likes] == ["c", "b", "a"]
+        assert likes[0]["added_at"] == "2020-03-01T00:00:00Z"
+        assert store.SyncState.get_state(act.user, "likes_reconciled")
+
+    def test_incremental_stops_at_known_likes(self, act):
+        with_likes(act, self.likes)
+        act.collect_likes(page_size=1)
+        with_likes(act, [saved("d", "2020-04-01T00:00:00Z")] + self.likes)
+        act.collect_likes(page_size=1)
+        assert act.fetched == 2  # the new like and the first one we knew
+        assert store.Liked.select().count() == 4
+
+    def test_watermark(self, act):
+        with_likes(act, self.likes[1:])
+        act.collect_likes()
+        assert store.SyncState.get_state(act.user, "likes_watermark").value == (
+            "2020-02-01T00:00:00"
+        )
+        # liked in the same second of the watermark
+        with_likes(act, [saved("d", "2020-02-01T00:00:00Z")] + self.likes[1:])
+        act.collect_likes(page_size=2)
+        assert act.fetched == 2
+        assert store.Liked.select().count() == 3
+
+    def test_reconciliation_removes_unlikes(self, act):
+        with_likes(act, self.likes)
+        act.collect_likes()
+        with_likes(act, self.likes[:1] + self.likes[2:])
+        act.collect_likes(full=True)
+        assert [liked["track"]["id"] for liked in act.stored_likes()] == ["c", "a"]
+
+    def test_count_mismatch_reconciles(self, act):
+        with_likes(act, self.likes)
+        act.collect_likes()
+        # unliked on Spotify, before the periodic reconciliation
+        with_likes(act, self.likes[:1] + self.likes[2:])
+        likes = act.cached_likes()
+        assert [liked["track"]["id"] for liked in likes] == ["c", "a"]
+
+
+def saved_song(track_id, name, added_at):
+    return saved(track_id, added_at, name=name)
+
+
+class TestDuplicates:
+    def unliked(self, act, likes, sent=True):
+        with_likes(act, likes)
+        unliked = set()
+
+        def unlike_tracks(tracks):
+            unliked.update(tracks)
+            return sent
+
+        act.unlike_tracks = unlike_tracks
+        act.remove_liked_duplicates()
+        return unliked
+
+    def test_keep_the_oldest(self, act):
+        likes = [
+            saved_song("c", "Other", "2020-03-01T00:00:00Z"),
+            saved_song("b", "Song", "2020-02-01T00:00:00Z"),
+            saved_song("a", "Song", "2020-01-01T00:00:00Z"),
+        ]
+        assert self.unliked(act, likes) == {"b"}
+        assert "Song" in store.Message.get().message
+
+    def test_only_the_new_likes_are_checked(self, act):
+        likes = [
+            saved_song("b", "Song", "2020-02-01T00:00:00Z"),
+            saved_song("a", "Song", "2020-01-01T00:00:00Z"),
+        ]
+        self.unliked(act, likes)  # we keep both - we don't really unlike here
+        likes.insert(0, saved_song("d", "New", "2020-04-01T00:00:00Z"))
+        likes.insert(0, saved_song("e", "New", "2020-05-01T00:00:00Z"))
+        assert self.unliked(act, likes) == {"e"}
+
+    def test_checked_again_until_unliked(self, act):
+        likes = [
+            saved_song("b", "Song", "2020-02-01T00:00:00Z"),
+            saved_song("a", "Song", "2020-01-01T00:00:00Z"),
+        ]
+        assert self.unliked(act, likes, sent=False) == {"b"}
+        assert self.unliked(act, likes) == {"b"}
+        assert self.unliked(act, likes) == set()
+
+    def test_unliked_version_is_not_kept(self, act):
+        with_likes(act, [saved_song("a", "Song", "2020-01-01T00:00:00Z")])
+        act.collect_likes()
+        likes = [saved_song("b", "Song", "2020-02-01T00:00:00Z")]
+        with_likes(act, likes)
+        act.collect_likes()
+        # a was unliked, but the counts match before the reconciliation
+        act.refresh_likes = lambda: None
+        assert act.remove_liked_duplicates(dry_run=True) == {}
+        assert len(list(act.stored_likes())) == 2  # the dry run doesn't forget them
+        assert self.unliked(act, likes) == set()
+        assert [liked["track"]["id"] for liked in act.stored_likes()] == ["b"]
+
+    def test_fuzzy_dry_run(self, act):
+        with_likes(
+            act,
+            [
+                saved_song("b", "Song - Remastered 2011", "2020-02-01T00:00:00Z"),
+                saved_song("a", "Song", "2020-01-01T00:00:00Z"),
+            ],
+        )
+        assert act.remove_liked_duplicates(fuzzy=False) == {}
+        found = act.remove_liked_duplicates(fuzzy=True, dry_run=True)
+        assert [
+            track_id for track_id, _ in found["Song - Remastered 2011", 180000]
+        ] == [
+            "b",
+            "a",
+        ]
+        assert not store.Message.select().exists()
@@ -90,3 +90,12 @@ class TestChunkSplitting:
         haystack = []
         chunks = list(reverse_block_chunks(haystack, 3))
         assert chunks == []
+
+
+class TestMergeStreams:
+    def test_generators_and_removed_tracks(self):
+        likes = (song("2020-08-22", track_id) for track_id in "cba")
+        current = iter([song("2020-01-22", "a"), dict(added_at="2020", track=None)])
+        to_add, to_del = sync_merge(likes, current, full=True)
+        assert to_add == ["c", "b"]
+        assert to_del == []
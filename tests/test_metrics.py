@@ -0,0 +1,87 @@
+import pytest
+from spotipy import SpotifyException
+
+import store
+from metrics import Metrics, metrics
+from spotclient import endpoint_name
+from tests.fakes import get_client
+
+
+@pytest.fixture
+def clean_metrics():
+    metrics.reset()
+    yield metrics
+    metrics.reset()
+
+
+class TestMetrics:
+    def test_render(self):
+        m = Metrics()
+        m.incr("spotify_retries", endpoint="GET me/tracks")
+        m.incr("spotify_retries", endpoint="GET me/tracks")
+        m.observe("db_query_seconds", 0.5, model="Track")
+        m.observe("db_query_seconds", 1.5, model="Track")
+        m.observe("db_query_seconds", 0.25, model='we"ird')
+
+        lines = m.render().splitlines()
+        assert lines == [
+            "# TYPE spotlike_spotify_retries_total counter",
+            'spotlike_spotify_retries_total{endpoint="GET me/tracks"} 2',
+            "# TYPE spotlike_db_query_seconds summary",
+            'spotlike_db_query_seconds_count{model="Track"} 2',
+            'spotlike_db_query_seconds_sum{model="Track"} 2.000000',
+            'spotlike_db_query_seconds_count{model="we\\"ird"} 1',
+            'spotlike_db_query_seconds_sum{model="we\\"ird"} 0.250000',
+            "# TYPE spotlike_db_query_seconds_max gauge",
+            'spotlike_db_query_seconds_max{model="Track"} 1.500000',
+            'spotlike_db_query_seconds_max{model="we\\"ird"} 0.250000',
+        ]
+
+    def test_summary(self):
+        m = Metrics()
+        m.observe("cron_phase_seconds", 1, phase="collect_likes")
+        m.observe("cron_phase_seconds", 3, phase="sync_playlist")
+        m.incr("cron_phase_errors", phase="sync_playlist")
+        assert m.summary() == [
+            'cron_phase_seconds{phase="sync_playlist"}: 1 in 3.00s'
+            " (avg 3000.0ms, max 3000.0ms)",
+            'cron_phase_seconds{phase="collect_likes"}: 1 in 1.00s'
+            " (avg 1000.0ms, max 1000.0ms)",
+            'cron_phase_errors{phase="sync_playlist"}: 1',
+        ]
+
+    def test_endpoint_name(self):
+        assert endpoint_name("me/tracks") == "me/tracks"
+        assert (
+            endpoint_name(
+                "https://api.spotify.com/v1/playlists/37i9dQZF1DXcBWIGoYBM5M/tracks"
+                "?offset=100&limit=100"
+            )
+            == "playlists/{id}/tracks"
+        )
+        assert endpoint_name("users/dariosky/playlists") == "users/{id}/playlists"
+
+
+class TestInstrumentation:
+    def test_queries_per_model(self, memory_db, clean_metrics):
+        store.User.create(id="me", name="Me", email="me@e.com", tokens={})
+        store.User.get_by_id("me")
+        list(store.Track.select())
+
+        _, timers = clean_metrics.snapshot()
+        assert timers["db_query_seconds", (("model", "User"),)][0] == 2
+        assert timers["db_query_seconds", (("model", "Track"),)][0] == 1
+
+    def test_spotify_calls(self, monkeypatch, sleeps, clean_metrics):  # noqa: F811
+        throttled = SpotifyException(429, -1, "slow down", headers={"Retry-After": "1"})
+        client = get_client(monkeypatch, throttled)
+        client.current_user()
+
+        counters, timers = clean_metrics.snapshot()
+        endpoint = (("endpoint", "GET me"),)
+        assert timers["spotify_request_seconds", endpoint][0] == 2
+        assert counters["spotify_retries", endpoint] == 1
+        assert (
+            counters["spotify_failures", (("endpoint", "GET me"), ("status", "429"))]
+            == 1
+        )
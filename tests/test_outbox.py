@@ -0,0 +1,102 @@
+import pytest
+from spotipy import SpotifyException
+
+import store
+from tests.fakes import saved
+
+pytestmark = pytest.mark.usefixtures("memory_db")
+
+
+class TestOutbox:
+    def test_coalesce(self, act):
+        store.Outbox.enqueue(act.user, "add", ["a", "b"], playlist="pl")
+        store.Outbox.enqueue(act.user, "remove", ["b"], playlist="pl")
+        store.Outbox.enqueue(act.user, "like", ["b"])
+        changes = store.Outbox.select().order_by(store.Outbox.id)
+        assert [(c.playlist, c.track, c.action) for c in changes] == [
+            ("pl", "a", "add"),
+            ("pl", "b", "remove"),
+            ("", "b", "like"),
+        ]
+
+    def test_additions_keep_their_order(self, act):
+        tracks = [f"t{i}" for i in range(250)]
+        calls = []
+        act.spotify.playlist_add_items = lambda playlist, items, position: calls.append(
+            items
+        )
+        store.Outbox.enqueue(act.user, "add", tracks, playlist="pl")
+        assert act.drain_outbox()
+        assert [len(items) for items in calls] == [100, 100, 50]
+        # every batch goes on top
+        assert sum(reversed(calls), []) == tracks
+        assert not store.Outbox.select().exists()
+
+    def test_max_batches(self, act):
+        act.spotify.playlist_add_items = lambda *args, **kwargs: None
+        tracks = [f"t{i}" for i in range(150)]
+        store.Outbox.enqueue(act.user, "add", tracks, playlist="pl")
+        assert not act.drain_outbox(max_batches=1)
+        # the last 100 went on top, the first 50 are still pending
+        assert [c.track for c in store.Outbox.select().order_by(store.Outbox.id)] == (
+            tracks[:50]
+        )
+        assert act.drain_outbox()
+
+    def test_failed_batches_are_retried(self, act):
+        def fail(*args, **kwargs):
+            raise SpotifyException(503, -1, "unavailable")
+
+        act.spotify.current_user_saved_tracks_delete = fail
+        act.outbox_max_attempts = 2
+        store.Outbox.enqueue(act.user, "unlike", ["a"])
+        assert not act.drain_outbox()
+        assert store.Outbox.get().attempts == 1
+        assert not act.drain_outbox()
+        assert not store.Outbox.select().exists()  # we gave up
+
+    def test_unlike(self, act):
+        unliked = []
+        act.spotify.current_user_saved_tracks_delete = unliked.extend
+        store.Track.create(id="a", title="A song", duration=1)
+        store.Liked.create(user=act.user, track="a", date="2020-01-01 00:00:00")
+        act.unlike_tracks({"a"})
+        assert unliked == ["a"]
+        assert not store.Liked.select().exists()
+
+
+class TestInterruptedSync:
+    def test_resume_without_the_diff(self, act):
+        act.spotify.likes = [
+            saved("b", "2020-02-01T00:00:00Z"),
+            saved("a", "2020-01-01T00:00:00Z"),
+        ]
+        act.outbox_max_batches = 0  # interrupted before sending anything
+        act.sync_liked_with_playlist("Liked")
+        assert act.spotify.playlist_tracks == []
+        assert act.spotify.downloads == 1
+
+        act.outbox_max_batches = None
+        act.sync_liked_with_playlist("Liked")
+        assert act.spotify.downloads == 1
+        assert [t["track"]["id"] for t in act.spotify.playlist_tracks] == ["b", "a"]
+        # and then it's in sync
+        act.sync_liked_with_playlist("Liked")
+        assert act.spotify.downloads == 1
+
+    def test_dropped_changes_are_synced_again(self, act):
+        def not_found(*args, **kwargs):
+            raise SpotifyException(404, -1, "not found")
+
+        act.spotify.likes = [saved("a", "2020-01-01T00:00:00Z")]
+        add_items = act.spotify.playlist_add_items
+        act.spotify.playlist_add_items = not_found
+        act.outbox_max_attempts = 2
+        act.sync_liked_with_playlist("Liked")
+        act.sync_liked_with_playlist("Liked")  # resumed, and then dropped
+        assert not store.Outbox.select().exists()
+        assert act.spotify.playlist_tracks == []
+
+        act.spotify.playlist_add_items = add_items  # Spotify recovered
+        act.sync_liked_with_playlist("Liked")
+        assert [t["track"]["id"] for t in act.spotify.playlist_tracks] == ["a"]
@@ -0,0 +1,75 @@
+import pytest
+
+import store
+from tests.fakes import saved
+
+pytestmark = pytest.mark.usefixtures("memory_db")
+
+
+@pytest.fixture
+def act(act):
+    act.spotify.likes.append(saved("a", "2020-01-01T00:00:00Z"))
+    return act
+
+
+class TestSnapshotShortCircuit:
+    def test_unchanged_playlist_is_not_downloaded(self, act):
+        act.sync_liked_with_playlist("Liked")
+        assert [t["track"]["id"] for t in act.spotify.playlist_tracks] == ["a"]
+        act.sync_liked_with_playlist("Liked")
+        assert act.spotify.downloads == 1
+
+    def test_new_likes_are_synced(self, act):
+        act.sync_liked_with_playlist("Liked")
+        act.spotify.likes.insert(0, saved("b", "2020-02-01T00:00:00Z"))
+        act.sync_liked_with_playlist("Liked")
+        assert act.spotify.downloads == 2
+        assert [t["track"]["id"] for t in act.spotify.playlist_tracks] == ["b", "a"]
+
+    def test_edited_playlist_is_synced(self, act):
+        act.sync_liked_with_playlist("Liked")
+        act.spotify.snapshot += 1  # the user changed the playlist
+        act.sync_liked_with_playlist("Liked")
+        assert act.spotify.downloads == 2
+
+    def test_unliked_song_is_removed(self, act):
+        act.spotify.likes.insert(0, saved("b", "2020-02-01T00:00:00Z"))
+        act.sync_liked_with_playlist("Liked")
+        del act.spotify.likes[1]  # unliked on Spotify
+        act.sync_liked_with_playlist("Liked")
+        assert [t["track"]["id"] for t in act.spotify.playlist_tracks] == ["b"]
+        act.sync_liked_with_playlist("Liked")
+        assert act.spotify.downloads == 2
+
+    def test_fast_sync_does_not_skip_the_full_one(self, act):
+        act.spotify.likes.insert(0, saved("b", "2020-02-01T00:00:00Z"))
+        act.spotify.playlist_tracks = [saved(t, "2020-01-01T00:00:00Z") for t in "ax"]
+        act.sync_liked_with_playlist("Liked", full=False)
+        assert [t["track"]["id"] for t in act.spotify.playlist_tracks] == [
+            "b",
+            "a",
+            "x",
+        ]
+        act.sync_liked_with_playlist("Liked", full=False)
+        assert act.spotify.downloads == 1
+
+        act.sync_liked_with_playlist("Liked")  # the song not liked goes away
+        assert [t["track"]["id"] for t in act.spotify.playlist_tracks] == ["b", "a"]
+
+    def test_reconciliation_forgets_the_sync(self, act):
+        act.sync_liked_with_playlist("Liked")
+        assert store.SyncState.get_state(act.user, "playlist_sync:Liked:full")
+        act.spotify.likes = []
+        act.collect_likes(full=True)
+        assert not store.SyncState.get_state(act.user, "playlist_sync:Liked:full")
+        assert not store.SyncState.get_state(act.user, "playlist_sync:Liked:fast")
+
+    def test_resumed_after_another_drain(self, act):
+        act.outbox_max_batches = 0  # interrupted before sending anything
+        act.sync_liked_with_playlist("Liked")
+        act.outbox_max_batches = None
+        act.drain_outbox()  # the changes are sent, but not by the sync
+        act.sync_liked_with_playlist("Liked")
+        # the state has the snapshot after the changes: the next run skips the sync
+        act.sync_liked_with_playlist("Liked")
+        assert act.spotify.downloads == 1
@@ -0,0 +1,63 @@
+import datetime
+
+import pytest
+
+import store
+from spottools import get_recent, store_tracks
+from tests.fakes import spotify_track
+
+pytestmark = pytest.mark.usefixtures("memory_db")
+
+
+def played(track_id, played_at):
+    return dict(played_at=played_at, track=spotify_track(track_id))
+
+
+class TestRecentFeed:
+    def test_collected_plays_are_in_the_feed(self, act):
+        plays = [
+            played("c", "2020-01-03T00:00:00Z"),
+            played("b", "2020-01-02T00:00:00Z"),
+            played("a", "2020-01-01T00:00:00Z"),
+        ]
+        act.recently_played = lambda after=None: iter(plays)
+        act.collect_recent()
+
+        recents, cursor = get_recent(act.user, page_size=2)
+        assert [recent["track"]["id"] for recent in recents] == ["c", "b"]
+        assert recents[0]["track"]["album"]["name"] == "Album album"
+        assert recents[0]["track"]["artists"] == [
+            dict(id="artist", name="Artist artist")
+        ]
+        next_page, cursor = get_recent(act.user, page_size=2, cursor=cursor)
+        assert [recent["track"]["id"] for recent in next_page] == ["a"]
+        assert cursor is None
+
+    def test_watermark_drives_the_fetch(self, act):
+        calls = []
+
+        def recently_played(after=None):
+            calls.append(after)
+            return iter(plays)
+
+        plays = [played("a", "2020-01-01T00:00:00.500Z")]
+        act.recently_played = recently_played
+        act.collect_recent()
+        plays = [played("b", "2020-01-02T00:00:00Z")] + plays
+        act.collect_recent()
+
+        assert calls == [None, 1577836800500]
+        assert store.Play.select().count() == 2
+        watermark = store.SyncState.get_state(act.user, "plays_watermark")
+        assert watermark.value == "2020-01-02T00:00:00"
+
+    def test_old_plays_are_filled(self, act):
+        store_tracks([spotify_track("old")])
+        store.Play.create(
+            user=act.user, track="old", date=datetime.datetime(2019, 1, 1)
+        )
+        act.recently_played = lambda after=None: iter([])
+        act.collect_recent()
+        (recent,), _ = get_recent(act.user)
+        assert recent["id"] == "old-2019-01-01 00:00"
+        assert recent["track"]["artists"] == [dict(id="artist", name="Artist artist")]
@@ -0,0 +1,79 @@
+import pytest
+import requests
+from spotipy import SpotifyException
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+import spotclient
+from spotclient import RequestStats, TokenBucket
+from tests.fakes import get_client
+
+
+class TestTokenBucket:
+    def test_burst_then_wait(self, sleeps):
+        bucket = TokenBucket(rate=10, capacity=2)
+        assert bucket.acquire() == 0
+        assert bucket.acquire() == 0
+        assert bucket.acquire() == pytest.approx(0.1, abs=0.01)
+
+    def test_pause(self, sleeps):
+        bucket = TokenBucket(rate=10)
+        bucket.pause(3)
+        assert bucket.acquire() == pytest.approx(3, abs=0.01)
+
+
+class TestRetries:
+    def test_retry_after(self, monkeypatch, sleeps):
+        throttled = SpotifyException(429, -1, "slow down", headers={"Retry-After": "7"})
+        client = get_client(monkeypatch, throttled)
+        assert client.current_user() == {"ok": True}
+        stats = client.stats.snapshot()
+        assert stats["requests"] == 2
+        assert stats["retries"] == stats["rate_limited"] == 1
+        assert 7 <= sleeps[0] <= 8
+
+    def test_server_errors_backoff(self, monkeypatch, sleeps):
+        error = SpotifyException(502, -1, "bad gateway")
+        client = get_client(monkeypatch, error, error, error)
+        assert client.current_user() == {"ok": True}
+        assert client.stats.snapshot()["retries"] == 3
+
+    def test_client_errors_are_not_retried(self, monkeypatch, sleeps):
+        client = get_client(monkeypatch, SpotifyException(404, -1, "not found"))
+        with pytest.raises(SpotifyException):
+            client.current_user()
+        assert client.stats.snapshot()["errors"] == 1
+        assert not sleeps
+
+    def test_give_up(self, monkeypatch, sleeps):
+        error = SpotifyException(503, -1, "unavailable")
+        client = get_client(monkeypatch, error, error, error, max_retries=2)
+        with pytest.raises(SpotifyException):
+            client.current_user()
+        assert len(sleeps) == 2
+
+    def test_writes_are_not_resent(self, monkeypatch, sleeps):
+        timeout = requests.exceptions.ReadTimeout("no answer")
+        client = get_client(monkeypatch, timeout)
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            client.playlist_add_items("pl", ["t"])  # it may be in the playlist already
+        assert not sleeps
+
+        client = get_client(monkeypatch, SpotifyException(502, -1, "bad gateway"))
+        with pytest.raises(SpotifyException):
+            client.playlist_add_items("pl", ["t"])
+
+    def test_writes_retried_when_not_sent(self, monkeypatch, sleeps):
+        throttled = SpotifyException(429, -1, "slow down", headers={"Retry-After": "1"})
+        refused = requests.exceptions.ConnectionError(
+            MaxRetryError(None, "url", NewConnectionError(None, "refused"))
+        )
+        client = get_client(monkeypatch, throttled, refused)
+        assert client.playlist_add_items("pl", ["t"]) == {"ok": True}
+        assert client.stats.snapshot()["retries"] == 2
+
+    def test_writes_may_have_been_sent_by_default(self):
+        client = spotclient.RetryingClientMixin()
+        client.setup_retries(stats=RequestStats())
+        error = ConnectionError("reset")
+        assert client.next_retry_delay(error, 0, "POST", method="POST") is None
+        assert client.next_retry_delay(error, 0, "GET", method="GET") is not None
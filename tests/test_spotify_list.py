@@ -0,0 +1,98 @@
+import urllib.parse
+
+import pytest
+
+import store
+from spottools import SpotUserActions, compact_saved, page_url, store_tracks
+from tests.fakes import spotify_track
+
+pytestmark = pytest.mark.usefixtures("memory_db")
+
+API_URL = "https://api.spotify.com/v1/me/tracks"
+
+
+class FakeSpotify:
+    """Serve `total` items in pages of `limit`, counting the requests"""
+
+    def __init__(self, total, limit=10):
+        self.total, self.limit = total, limit
+        self.requests = []
+
+    def page(self, offset):
+        end = min(offset + self.limit, self.total)
+        return dict(
+            items=list(range(offset, end)),
+            offset=offset,
+            limit=self.limit,
+            total=self.total,
+            next=(
+                f"{API_URL}?limit={self.limit}&offset={end}"
+                if end < self.total
+                else None
+            ),
+        )
+
+    def next(self, result):
+        self.requests.append(result["next"])
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(result["next"]).query)
+        return self.page(int(query["offset"][0]))
+
+
+def get_act(spotify):
+    act = SpotUserActions(auth_manager=object(), connect=False)
+    act.spotify = spotify
+    return act
+
+
+class TestSpotifyList:
+    def test_page_url(self):
+        assert (
+            page_url(f"{API_URL}?offset=50&limit=50&market=IT", 150)
+            == f"{API_URL}?offset=150&limit=50&market=IT"
+        )
+
+    def test_sequential(self):
+        spotify = FakeSpotify(total=35)
+        act = get_act(spotify)
+        assert list(act.get_spotify_list(spotify.page(0))) == list(range(35))
+        assert len(spotify.requests) == 3
+
+    def test_prefetch_keeps_the_order(self):
+        spotify = FakeSpotify(total=95)
+        act = get_act(spotify)
+        items = list(act.get_spotify_list(spotify.page(0), prefetch=True))
+        assert items == list(range(95))
+        assert len(spotify.requests) == 9
+
+    def test_prefetch_early_stop(self):
+        spotify = FakeSpotify(total=1000)
+        act = get_act(spotify)
+        items = act.get_spotify_list(spotify.page(0), prefetch=True)
+        assert [item for item, _ in zip(items, range(15))] == list(range(15))
+        items.close()
+        # we don't download everything when the consumer stops
+        assert len(spotify.requests) <= 2 * act.prefetch_workers + 1
+
+    @pytest.mark.parametrize("prefetch", [False, True])
+    def test_projection(self, prefetch):
+        spotify = FakeSpotify(total=35)
+        act = get_act(spotify)
+        items = act.get_spotify_list(
+            spotify.page(0), prefetch=prefetch, project=lambda item: -item
+        )
+        assert list(items) == [-item for item in range(35)]
+
+
+class TestCompactItems:
+    def test_compact_saved(self):
+        track = spotify_track("a")
+        track["available_markets"] = ["IT", "US"]
+        track["album"]["images"] = [dict(url="big"), dict(url="small")]
+        liked = compact_saved(dict(added_at="2020-01-01T00:00:00Z", track=track))
+
+        assert "available_markets" not in liked["track"]
+        assert liked["track"]["album"]["images"] == [dict(url="big")]
+        # it has all we store
+        store_tracks([liked["track"]])
+        assert store.Album.get().picture == "big"
+        assert store.TrackArtist.select().count() == 1
@@ -0,0 +1,86 @@
+import datetime
+
+import pytest
+
+import store
+from spottools import store_tracks
+from stats import play_stats
+from tests.fakes import spotify_track
+
+pytestmark = pytest.mark.usefixtures("memory_db")
+
+NOW = datetime.datetime(2020, 2, 1)
+
+
+@pytest.fixture
+def plays(act):
+    store_tracks(
+        [
+            spotify_track("a", album_id="first", artist_id="one"),
+            spotify_track("b", album_id="first", artist_id="two"),
+            spotify_track("c", album_id="second", artist_id="two"),
+        ]
+    )
+    for track_id, days_ago in (
+        ("a", 1),
+        ("a", 2),
+        ("a", 20),
+        ("b", 3),
+        ("c", 10),
+        ("c", 11),
+        ("c", 12),
+        ("c", 400),
+    ):
+        store.Play.create(
+            user=act.user, track=track_id, date=NOW - datetime.timedelta(days=days_ago)
+        )
+    return act.user
+
+
+class TestPlayStats:
+    def test_tracks(self, plays):
+        stats = play_stats(plays, "track", windows=(7, 30), now=NOW)
+        assert [(s["id"], s["plays"]) for s in stats] == [
+            ("a", {7: 2, 30: 3}),
+            ("b", {7: 1, 30: 1}),
+        ]
+        assert stats[0]["last_played"] == NOW - datetime.timedelta(days=1)
+
+    def test_artists_and_albums(self, plays):
+        artists = play_stats(plays, "artist", windows=(30, 365), now=NOW)
+        assert [(s["id"], s["plays"]) for s in artists] == [
+            ("two", {30: 4, 365: 4}),
+            ("one", {30: 3, 365: 3}),
+        ]
+        albums = play_stats(plays, "album", windows=(30,), now=NOW)
+        assert [(s["id"], s["plays"][30]) for s in albums] == [
+            ("first", 4),
+            ("second", 3),
+        ]
+
+    def test_min_plays_and_limit(self, plays):
+        stats = play_stats(plays, "track", windows=(30,), min_plays=3, now=NOW)
+        assert [s["id"] for s in stats] == ["a", "c"]
+        assert len(play_stats(plays, "track", windows=(30,), limit=1, now=NOW)) == 1
+
+    def test_invalid(self, plays):
+        with pytest.raises(ValueError):
+            play_stats(plays, "genre")
+        with pytest.raises(ValueError):
+            play_stats(plays, windows=(0,))
+        with pytest.raises(ValueError):
+            play_stats(plays, windows=(999999999,))
+        with pytest.raises(ValueError):
+            play_stats(plays, limit=-1)
+
+
+class TestAutoLike:
+    def test_like_the_recurrent_songs(self, act, plays):
+        act.spotify.top_tracks = ["b"]
+        act.collect_recent = act.collect_likes = lambda: None
+        store.Liked.create(user=act.user, track="c", date=NOW)
+
+        # "c" is played often too, but it's already liked - "b" is a top track
+        assert act.auto_like_recurrent(played_times=2, day_period=10000) == {"a", "b"}
+        assert act.spotify.added_likes == ["a", "b"]
+        assert not store.Outbox.select().exists()
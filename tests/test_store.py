@@ -0,0 +1,313 @@
+import datetime
+from collections import Counter
+from types import SimpleNamespace
+
+import peewee
+import pytest
+from playhouse.migrate import migrate
+
+import store
+from spotclient import RateLimitedSpotify
+from spottools import SpotUserActions, prewarm_catalog_cache, store_tracks
+from tests.fakes import spotify_track
+
+pytestmark = pytest.mark.usefixtures("memory_db")
+
+
+class TestBulkUpsert:
+    def test_insert_then_update(self):
+        assert store.Artist.bulk_upsert(
+            [dict(id="a", name="A"), dict(id="b", name="B")]
+        ) == (2, 0)
+        # only the changed row is touched
+        assert store.Artist.bulk_upsert(
+            [dict(id="a", name="A"), dict(id="b", name="Bee"), dict(id="c", name="C")]
+        ) == (1, 1)
+        assert store.Artist.get_by_id("b").name == "Bee"
+
+    def test_null_change_is_detected(self):
+        store.Artist.bulk_upsert([dict(id="a", name="A", picture=None)])
+        assert store.Artist.bulk_upsert([dict(id="a", name="A", picture="pic")]) == (
+            0,
+            1,
+        )
+
+    def test_duplicated_rows_in_batch(self):
+        assert store.Artist.bulk_upsert(
+            [dict(id="a", name="A"), dict(id="a", name="A2")]
+        ) == (1, 0)
+        assert store.Artist.get_by_id("a").name == "A2"
+
+    def test_composite_key(self):
+        store.Track.create(id="t", title="T", duration=1)
+        store.Artist.create(id="a", name="A")
+        rows = [dict(track="t", artist="a")]
+        assert store.TrackArtist.bulk_upsert(rows) == (1, 0)
+        assert store.TrackArtist.bulk_upsert(rows) == (0, 0)
+
+    def test_small_batches(self):
+        rows = [dict(id=str(i), name=str(i)) for i in range(25)]
+        assert store.Artist.bulk_upsert(rows, batch_size=10) == (25, 0)
+
+
+class TestUpsert:
+    def test_insert_then_update(self):
+        assert store.Artist.upsert(dict(id="a", name="A")) == (True, False)
+        assert store.Artist.upsert(dict(id="a", name="A")) == (False, False)
+        assert store.Artist.upsert(dict(id="a", name="Aye")) == (False, True)
+        assert store.Artist.get_by_id("a").name == "Aye"
+
+    def test_only_the_update_fields(self):
+        store.Artist.upsert(dict(id="a", name="A", picture="pic"))
+        assert store.Artist.upsert(
+            dict(id="a", name="A", picture=None), update=["name"]
+        ) == (False, False)
+        assert store.Artist.get_by_id("a").picture == "pic"
+
+    def test_composite_key(self):
+        store.Track.create(id="t", title="T", duration=1)
+        store.Artist.create(id="a", name="A")
+        row = dict(track="t", artist="a")
+        assert store.TrackArtist.upsert(row) == (True, False)
+        assert store.TrackArtist.upsert(row) == (False, False)
+
+    def test_insert_or_update(self):
+        join_date = datetime.datetime(2020, 1, 1)
+        user = store.User(id="me", join_date=join_date).insert_or_update(
+            name="Me", email="me@example.com", tokens={"access": "1"}
+        )
+        assert user._new
+
+        store.user_cache.configure(ttl=60)
+        try:
+            assert store.user_cache.get("me").name == "Me"
+            user = store.User(id="me").insert_or_update(
+                name="Renamed", email="me@example.com", tokens={"access": "2"}
+            )
+            assert not user._new
+            assert store.user_cache.get("me").name == "Renamed"
+        finally:
+            store.user_cache.configure(ttl=0)
+        stored = store.User.get_by_id("me")
+        assert stored.tokens == {"access": "2"}
+        assert stored.join_date == join_date  # not in the update
+
+    def test_signup_message(self, monkeypatch):
+        profile = dict(id="me", display_name="Me", email="me@example.com", images=[])
+        monkeypatch.setattr(RateLimitedSpotify, "current_user", lambda self: profile)
+        auth_manager = SimpleNamespace(token_info={"access": "1"})
+
+        for _ in range(2):  # only the first connection signs up
+            act = SpotUserActions(auth_manager=auth_manager)
+        assert act.user.tokens == {"access": "1"}
+        assert [m.msg_type for m in store.Message.select()] == ["signup"]
+
+
+class TestStoreTracks:
+    def test_page_is_deduped(self):
+        stats = store_tracks(
+            [spotify_track("t1"), spotify_track("t2"), spotify_track("t1")]
+        )
+        # 1 artist, 1 album, 1 album-artist, 2 tracks, 2 track-artists
+        assert stats["inserted"] == 7
+        assert stats["changed"] == 0
+        assert store.Track.select().count() == 2
+
+    def test_restore_unchanged(self):
+        store_tracks([spotify_track("t1")])
+        stats = store_tracks([spotify_track("t1")])
+        assert stats["inserted"] == stats["changed"] == 0
+
+        stats = store_tracks([spotify_track("t1", name="Renamed")])
+        assert stats["changed"] == 1
+        assert store.Track.get_by_id("t1").title == "Renamed"
+
+
+class TestKeysetPagination:
+    def test_pages_with_ties(self):
+        user = store.User.create(id="me", name="Me", email="me@example.com", tokens={})
+        date = datetime.datetime(2020, 1, 1)
+        for minutes in (0, 0, 0, 1, 2):
+            store.Message.create(
+                user=user, message="", date=date + datetime.timedelta(minutes=minutes)
+            )
+
+        seen, cursor = [], None
+        while True:
+            messages, cursor = store.paginate_keyset(
+                user.messages.select(), store.Message.date, store.Message.id, 2, cursor
+            )
+            seen += [message.id for message in messages]
+            if not cursor:
+                break
+        assert seen == [5, 4, 3, 2, 1]
+
+    def test_invalid_page_size(self):
+        for page_size in (0, -1):
+            with pytest.raises(ValueError):
+                store.paginate_keyset(
+                    store.Message.select(),
+                    store.Message.date,
+                    store.Message.id,
+                    page_size,
+                )
+
+    def test_invalid_cursor(self):
+        with pytest.raises(ValueError):
+            store.decode_cursor("not a cursor")
+
+
+class TestUserCache:
+    def test_cached_until_saved(self):
+        user = store.User.create(id="me", name="Me", email="me@example.com", tokens={})
+        cache = store.user_cache
+        cache.configure(ttl=60)
+        try:
+            assert cache.get("me").name == "Me"
+            store.User.update(name="Changed").execute()  # not through the model
+            assert cache.get("me").name == "Me"
+            user.name = "Saved"
+            user.save()
+            assert cache.get("me").name == "Saved"
+            assert cache.get("nobody") is None
+        finally:
+            cache.configure(ttl=0)
+
+
+@pytest.fixture
+def catalog_cache():
+    store.catalog_cache.configure(100)
+    yield store.catalog_cache
+    store.catalog_cache.configure(store.CATALOG_CACHE_SIZE)
+
+
+class TestCatalogCache:
+    def test_unchanged_rows_are_skipped(self, catalog_cache):
+        store_tracks([spotify_track("t1"), spotify_track("t2")])
+        store.Track.update(title="Changed").execute()  # not through the cache
+
+        store_tracks([spotify_track("t1"), spotify_track("t2", name="Renamed")])
+        # all known, but the renamed track
+        assert store.Track.get_by_id("t1").title == "Changed"
+        assert store.Track.get_by_id("t2").title == "Renamed"
+        assert catalog_cache.stats() == dict(size=7, hits=6, misses=8, hit_rate=6 / 14)
+
+    def test_rollback_is_not_cached(self, catalog_cache):
+        with pytest.raises(RuntimeError):
+            with store.write_batch():
+                store_tracks([spotify_track("t1")])
+                raise RuntimeError("the page failed")
+        assert catalog_cache.stats()["size"] == 0
+
+        store_tracks([spotify_track("t1")])
+        assert store.Track.get_by_id("t1")
+
+    def test_prewarm(self, catalog_cache):
+        store_tracks([spotify_track("t1")])
+        catalog_cache.configure(100)
+        assert prewarm_catalog_cache() == 5
+
+        assert store_tracks([spotify_track("t1")]) == Counter()
+        assert catalog_cache.stats()["hits"] == 5
+
+    def test_new_database_empties_it(self, catalog_cache):
+        store_tracks([spotify_track("t1")])
+        store.configure_db(dict(path=":memory:"))
+        store.db.create_tables(store.MODELS)
+
+        store_tracks([spotify_track("t1")])
+        assert store.Track.get_by_id("t1")
+
+
+class TestDatabaseConfig:
+    def test_pragmas(self, tmp_path):
+        database = store.get_database(
+            dict(path=str(tmp_path / "test.db"), pragmas=dict(busy_timeout=500))
+        )
+        database.connect()
+        try:
+            assert database.journal_mode == "wal"
+            assert database.synchronous == 1  # NORMAL
+            assert database.pragma("busy_timeout") == 500
+            assert (
+                database.cache_size == store.DATABASE_DEFAULTS["pragmas"]["cache_size"]
+            )
+        finally:
+            database.close()
+
+    def test_pool(self, tmp_path):
+        database = store.get_database(
+            dict(path=str(tmp_path / "test.db"), pool=True, max_connections=2)
+        )
+        assert isinstance(database, store.PooledSqliteDatabase)
+        assert database._max_connections == 2
+
+    def test_postgres(self):
+        database = store.get_database(
+            dict(engine="postgres", name="spotlike", host="db", pool=True)
+        )
+        assert isinstance(database, store.PooledPostgresqlDatabase)
+        assert database.database == "spotlike"
+        assert database.connect_params == dict(host="db")
+
+    def test_unknown_engine(self):
+        with pytest.raises(ValueError):
+            store.get_database(dict(engine="oracle"))
+
+
+class TestMigrations:
+    @pytest.fixture
+    def migrations(self, monkeypatch):
+        migrations = []
+        monkeypatch.setattr(store, "MIGRATIONS", migrations)
+        return migrations
+
+    def test_new_database_is_up_to_date(self, migrations, tmp_path):
+        applied = []
+        migrations.append((1, applied.append))
+        store.configure_db(dict(path=str(tmp_path / "new.db")))
+        store.initdb()
+
+        assert applied == []
+        assert [v.version for v in store.SchemaVersion.select()] == [1]
+
+    def test_pending_migrations_run_once(self, migrations):
+        def add_rating(migrator):
+            migrate(
+                migrator.add_column("track", "rating", peewee.IntegerField(null=True))
+            )
+
+        store.Track.create(id="t", title="A song", duration=1)
+        migrations.append((1, add_rating))
+        store.initdb()
+        store.initdb()
+
+        assert [v.name for v in store.SchemaVersion.select()] == ["add_rating"]
+        columns = {c.name for c in store.db.get_columns("track")}
+        assert "rating" in columns
+
+    def test_compact_history(self):
+        store.User.create(id="me", name="Me", email="me@example.com", tokens={})
+        store.Track.create(id="t", title="A song", duration=1)
+        for table in ("play", "liked"):
+            store.db.execute_sql(f'DROP TABLE "{table}"')
+            store.db.execute_sql(
+                f'CREATE TABLE "{table}" ("user_id" VARCHAR, "track_id" VARCHAR,'
+                f' "date" DATETIME, PRIMARY KEY ("user_id", "track_id", "date"))'
+            )
+        store.db.execute_sql(
+            "INSERT INTO play VALUES ('me', 't', '2020-01-02 10:30:00.250000')"
+        )
+        store.db.execute_sql(
+            "INSERT INTO liked VALUES ('me', 't', '2020-01-01 08:00:00')"
+        )
+        store.initdb()
+
+        play = store.Play.get()
+        assert play.date == datetime.datetime(2020, 1, 2, 10, 30, 0, 250000)
+        assert store.Liked.get().date == datetime.datetime(2020, 1, 1, 8)
+        assert [v.version for v in store.SchemaVersion.select()] == [1, 2, 3]
+        # the new layout: the integer id and the unique index for the upserts
+        assert store.Liked.bulk_upsert(
+            [dict(user="me", track="t", date=datetime.datetime(2020, 1, 1, 8))]
+        ) == (0, 0)
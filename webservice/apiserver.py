@@ -1,5 +1,7 @@
 import functools
+import hmac
 import os
+import time
 import traceback
 from typing import Optional
 
@@ -11,8 +13,10 @@ from spotipy import SpotifyOauthError
 from werkzeug.exceptions import NotFound
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+from metrics import metrics
 from spottools import SpotUserActions, get_auth_manager, get_recent
-from store import User, Message, Friendship
+from stats import DEFAULT_WINDOWS, play_stats
+from store import User, Message, Friendship, db, paginate_keyset, user_cache
 from webservice.config import get_config, activate_config
 
 try:
@@ -39,6 +43,7 @@ def get_app(config):
     proxied = config.get("PROXIED", True)
     api_prefix = config.get("API_PREFIX", "/api")
     activate_config(config)
+    user_cache.configure(config.get("USER_CACHE_TTL", 0))
     error_log_endpoint = config.get("WEBHOOK_LOGGER")
     error_log_session = requests.session() if error_log_endpoint else None
     debug = config.get("DEVSERVER", True)
@@ -56,6 +61,30 @@ def get_app(config):
     if proxied:
         app.wsgi_app = ProxyFix(app.wsgi_app)
 
+    @app.before_request
+    def db_connect():
+        flask.g.request_start = time.perf_counter()
+        db.connect(reuse_if_open=True)
+
+    @app.after_request
+    def time_request(response):
+        if "request_start" in flask.g:
+            rule = flask.request.url_rule
+            metrics.observe(
+                "http_request_seconds",
+                time.perf_counter() - flask.g.request_start,
+                route=rule.rule if rule else "unmatched",
+                method=flask.request.method,
+                status=response.status_code,
+            )
+        return response
+
+    @app.teardown_request
+    def db_close(exc):
+        # with a pool, this gives the connection back to it
+        if not db.is_closed():
+            db.close()
+
     def login_required(func):
         """Wrapper to ensure user is logged"""
 
@@ -68,9 +97,11 @@ def get_app(config):
         return wrapper
 
     def current_user() -> Optional[User]:
-        uid = flask.session.get("uid")
-        if uid:
-            return User.get_by_id(uid)
+        """The logged user - loaded once per request"""
+        if "user" not in flask.g:
+            uid = flask.session.get("uid")
+            flask.g.user = user_cache.get(uid) if uid else None
+        return flask.g.user
 
     @app.post(f"{api_prefix}/logout")
     @login_required
@@ -87,6 +118,21 @@ def get_app(config):
     def get_status():
         return {"status": "OK"}
 
+    metrics_token = config.get("METRICS_TOKEN")
+    if metrics_token:  # the metrics are exposed only to who has the token
+
+        @app.get(f"{api_prefix}/metrics")
+        def get_metrics():
+            authorization = flask.request.headers.get("Authorization", "")
+            if not hmac.compare_digest(
+                authorization.encode(), f"Bearer {metrics_token}".encode()
+            ):
+                return dict(error="Not authorized"), 401
+            return flask.Response(
+                metrics.render(),
+                content_type="text/plain; version=0.0.4; charset=utf-8",
+            )
+
     @app.get(f"{api_prefix}/user")
     def get_current_user():
         uid = flask.session.get("uid")
@@ -101,7 +147,9 @@ def get_app(config):
                 401,
             )
         else:
-            user = User.get_by_id(uid)
+            user = current_user()
+            if not user:
+                return dict(error="Not logged in"), 401
             # act = SpotUserActions(user=user)
             return dict(
                 id=user.id,
@@ -142,30 +190,58 @@ def get_app(config):
     @app.get(f"{api_prefix}/events")
     @login_required
     def events():
-        page = flask.request.args.get("page", 1)
-        items = flask.request.args.get("items", 30)
-        messages = (
-            current_user()
-            .messages.select()
-            .order_by(Message.date.desc())
-            .paginate(page, items)
-        )
+        items = flask.request.args.get("items", 30, type=int)
+        try:
+            messages, next_cursor = paginate_keyset(
+                current_user().messages.select(),
+                Message.date,
+                Message.id,
+                items,
+                flask.request.args.get("cursor"),
+            )
+        except ValueError as e:
+            return {"message": str(e)}, 400
         return {
             "items": [
                 dict(id=message.id, message=message.message, date=message.date)
                 for message in messages
-            ]
+            ],
+            "next": next_cursor,
         }
 
     @app.get(f"{api_prefix}/recents")
     @login_required
     def recents():
-        page = flask.request.args.get("page", 1)
-        items = flask.request.args.get("items", 30)
+        items = flask.request.args.get("items", 30, type=int)
+        try:
+            recents_page, next_cursor = get_recent(
+                user=current_user(),
+                page_size=items,
+                cursor=flask.request.args.get("cursor"),
+            )
+        except ValueError as e:
+            return {"message": str(e)}, 400
 
-        recents_page = get_recent(user=current_user(), page=page, page_size=items)
+        return {"items": recents_page, "next": next_cursor}
 
-        return {"items": recents_page}
+    @app.get(f"{api_prefix}/stats")
+    @login_required
+    def stats():
+        """The most played tracks, artists or albums over rolling windows of days"""
+        args = flask.request.args
+        try:
+            windows = tuple(
+                int(days) for days in args.get("windows", "").split(",") if days
+            )
+            items = play_stats(
+                current_user(),
+                by=args.get("by", "track"),
+                windows=windows or DEFAULT_WINDOWS,
+                limit=min(args.get("items", 20, type=int), 100),
+            )
+        except ValueError as e:
+            return {"message": str(e)}, 400
+        return {"items": items}
 
     @app.get(f"{api_prefix}/profile/<string:email>")
     @login_required
@@ -1,6 +1,9 @@
 import json
 import os
 
+import spotclient
+import store
+
 
 def get_config(environment):
     webservice_path = os.path.abspath(
@@ -21,3 +24,8 @@ def activate_config(config=None):
         # pass some config to the env - for spotipy
         if envfield in config:
             os.environ[envfield] = config[envfield]
+    spotclient.configure(config)
+    store.configure_db(config.get("DATABASE"))
+    store.catalog_cache.configure(
+        config.get("CATALOG_CACHE_SIZE", store.CATALOG_CACHE_SIZE)
+    )
@@ -1,33 +1,114 @@
 import logging
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from spottools import SpotUserActions, SpotifyConnectionException
-from store import User, initdb
-from webservice.config import get_config
+from metrics import metrics
+from spotclient import request_stats
+from spottools import (
+    SpotUserActions,
+    SpotifyConnectionException,
+    prewarm_catalog_cache,
+)
+from store import User, catalog_cache, initdb, db
+from webservice.config import get_config, activate_config
 
 logger = logging.getLogger("spotlike.cron")
 
+DEFAULT_CONCURRENCY = 4
 
-def run_all_jobs():
+
+def user_jobs(act):
+    """The phases we run for every user - in order"""
+    return (
+        # what an interrupted run left to send - the playlists are resumed by their sync
+        ("drain_outbox", partial(act.drain_outbox, playlist="")),
+        ("remove_duplicates", act.remove_liked_duplicates),
+        ("sync_playlist", partial(act.sync_liked_with_playlist, name="Liked playlist")),
+        ("collect_recent", act.collect_recent),
+        ("collect_likes", act.collect_likes),
+    )
+
+
+def run_user_jobs(user):
+    """Run all the jobs of a user - isolated, so a failure doesn't stop the others.
+    Returns the stats of the run: the time spent in every phase and the error if any
+    """
+    stats = dict(user=str(user), phases={}, error=None)
+    start = time.monotonic()
+    phase = "connect"
+    try:
+        logger.debug(f"Processing {user}")
+        act = SpotUserActions(user)
+        # act.auto_like_recurrent()
+        for phase, job in user_jobs(act):
+            phase_start = time.monotonic()
+            job()
+            stats["phases"][phase] = time.monotonic() - phase_start
+            metrics.observe("cron_phase_seconds", stats["phases"][phase], phase=phase)
+    except SpotifyConnectionException as e:
+        logger.error(f"Cannot connect {user}: {e}")
+        stats["error"] = f"{phase}: {e}"
+        metrics.incr("cron_phase_errors", phase=phase)
+    except Exception as e:
+        logger.exception(f"Error processing {user} in {phase}")
+        stats["error"] = f"{phase}: {e!r}"
+        metrics.incr("cron_phase_errors", phase=phase)
+    finally:
+        db.close()  # every worker thread has its own connection
+    stats["elapsed"] = time.monotonic() - start
+    return stats
+
+
+def log_run_stats(all_stats, elapsed):
+    failed = [stats for stats in all_stats if stats["error"]]
+    logger.info(
+        f"Processed {len(all_stats)} users in {elapsed:.1f}s" f" - {len(failed)} failed"
+    )
+    for stats in sorted(all_stats, key=lambda s: s["elapsed"], reverse=True):
+        phases = ", ".join(
+            f"{phase} {seconds:.1f}s" for phase, seconds in stats["phases"].items()
+        )
+        logger.info(
+            f"{stats['user']}: {stats['elapsed']:.1f}s ({phases})"
+            + (f" - FAILED {stats['error']}" if stats["error"] else "")
+        )
+    logger.info(f"Spotify requests: {request_stats.snapshot()}")
+    cache = catalog_cache.stats()
+    if cache["hit_rate"] is not None:
+        logger.info(
+            f"Catalog cache: {cache['hit_rate']:.1%} hits"
+            f" ({cache['hits']} hits, {cache['misses']} misses, {cache['size']} rows)"
+        )
+    for line in metrics.summary():
+        logger.info(line)
+
+
+def run_all_jobs(concurrency=None):
     environment = os.environ.get("ENV", "dev")
     config = get_config(environment)
-    for envfield in ("SPOTIPY_CLIENT_SECRET", "SPOTIPY_CLIENT_ID"):
-        # pass some config to the env - for spotipy
-        if envfield in config:
-            os.environ[envfield] = config[envfield]
+    activate_config(config)
+    if concurrency is None:
+        concurrency = config.get("CRON_CONCURRENCY", DEFAULT_CONCURRENCY)
 
     initdb()
-    for user in User.select():
-        try:
-            logger.debug(f"Processing {user}")
-            act = SpotUserActions(user)
-            # act.auto_like_recurrent()
-            act.remove_liked_duplicates()
-            act.sync_liked_with_playlist(name="Liked playlist")
-            act.collect_recent()
-            act.collect_likes()
-        except SpotifyConnectionException as e:
-            logger.error(f"Cannot connect {user}: {e}")
+    request_stats.reset()
+    metrics.reset()
+    start = time.monotonic()
+    prewarmed = prewarm_catalog_cache()
+    logger.info(
+        f"Catalog cache prewarmed with {prewarmed} rows"
+        f" in {time.monotonic() - start:.1f}s"
+    )
+    users = list(User.select())
+    start = time.monotonic()
+    with ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix="spotlike-cron"
+    ) as pool:
+        all_stats = list(pool.map(run_user_jobs, users))
+    log_run_stats(all_stats, time.monotonic() - start)
+    return all_stats
 
 
 if __name__ == "__main__":